@@ -1,23 +1,34 @@
 # app.py (UPDATED)
-import os
-import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime
 import hashlib
-from flask import Flask, request, render_template, redirect, url_for, session, flash, Response, send_file
+from flask import Flask, request, render_template, redirect, url_for, session, flash, Response, g
 import io
 import csv
+import time
+import zlib
+from db_pool import DB_NAME, get_conn, run_write
+from session_store import create_session_store
+from migrations import migrate, next_change_seq
+import metrics
+from snapshot import snapshot_db
+import user_search
+import ussd_menu
+from ussd_cache import READ_CACHE, REPLY_CACHE, invalidate_phones, invalidate_users
+from utils import parse_since
 
 # ----------------------
 # APP SETUP
 # ----------------------
 app = Flask(__name__)
 app.secret_key = "super_secret_key"
+# Request timing and the /metrics endpoint; see metrics.py.
+metrics.init_app(app)
 
 # ----------------------
 # DATABASE
 # ----------------------
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_NAME = os.path.join(BASE_DIR, "users.db")
+# DB_NAME and connections come from db_pool: one long-lived connection per
+# thread and per process, opened lazily and reused by every helper below.
 
 # ----------------------
 # ADMIN LOGIN
@@ -29,50 +40,8 @@ ADMIN_PASSWORD_HASH = hashlib.sha256("admin123".encode()).hexdigest()
 # DATABASE INITIALIZATION
 # ----------------------
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # Users
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        session_id TEXT,
-        phone TEXT UNIQUE,
-        national_id TEXT,
-        full_name TEXT,
-        address TEXT,
-        father_name TEXT,
-        mother_name TEXT,
-        loan_amount REAL,
-        duration INTEGER,
-        date_registered TEXT
-    )
-    """)
-    # Repayments
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS repayments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount REAL,
-        due_date TEXT,
-        paid INTEGER DEFAULT 0
-    )
-    """)
-    # USSD sessions (persist multi-step USSD inputs)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS ussd_sessions (
-        session_id TEXT PRIMARY KEY,
-        phone TEXT,
-        step INTEGER DEFAULT 0,
-        national_id TEXT,
-        full_name TEXT,
-        address TEXT,
-        father_name TEXT,
-        mother_name TEXT,
-        loan_amount REAL
-    )
-    """)
-    conn.commit()
-    conn.close()
+    # Creates or upgrades the schema; see migrations.py.
+    migrate(DB_NAME)
 
 init_db()  # Ensure DB exists
 
@@ -80,27 +49,25 @@ init_db()  # Ensure DB exists
 # DB HELPERS
 # ----------------------
 def _get_conn():
-    return sqlite3.connect(DB_NAME)
+    return get_conn(DB_NAME)
 
 # ----------------------
 # USER FUNCTIONS
 # ----------------------
-def add_user(session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration):
-    conn = _get_conn()
-    c = conn.cursor()
+def _insert_user(conn, session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration):
     date_registered = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("""
+    return conn.execute("""
         INSERT INTO users (session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration, date_registered)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration, date_registered))
-    user_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    """, (session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration, date_registered)).lastrowid
+
+def add_user(session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration):
+    user_id = run_write(lambda conn: _insert_user(conn, session_id, phone, national_id, full_name, address,
+                                                  father_name, mother_name, loan_amount, duration), DB_NAME)
+    invalidate_phones(phone)
     return user_id
 
 def update_user(user_id, **fields):
-    conn = _get_conn()
-    c = conn.cursor()
     set_parts = []
     vals = []
     for k, v in fields.items():
@@ -109,77 +76,74 @@ def update_user(user_id, **fields):
     if set_parts:
         sql = "UPDATE users SET " + ", ".join(set_parts) + " WHERE id=?"
         vals.append(user_id)
-        c.execute(sql, tuple(vals))
-        conn.commit()
-    conn.close()
+        run_write(lambda conn: conn.execute(sql, tuple(vals)), DB_NAME)
+        invalidate_users(user_id)
+        if "phone" in fields:
+            invalidate_phones(fields["phone"])
 
 def search_users(search=""):
-    conn = _get_conn()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    if search:
-        c.execute("SELECT * FROM users WHERE full_name LIKE ? OR phone LIKE ?", (f"%{search}%", f"%{search}%"))
-    else:
-        c.execute("SELECT * FROM users")
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return user_search.search_users(search, DB_NAME)
 
 def get_user_by_id(user_id):
-    conn = _get_conn()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    row = _get_conn().execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
     return dict(row) if row else None
 
 def get_user_by_phone(phone):
-    conn = _get_conn()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE phone=?", (phone,))
-    row = c.fetchone()
-    conn.close()
+    row = _get_conn().execute("SELECT * FROM users WHERE phone=?", (phone,)).fetchone()
     return dict(row) if row else None
 
 def delete_user(user_id):
-    conn = _get_conn()
-    c = conn.cursor()
-    c.execute("DELETE FROM users WHERE id=?", (user_id,))
-    c.execute("DELETE FROM repayments WHERE user_id=?", (user_id,))
-    conn.commit()
-    conn.close()
+    def _delete(conn):
+        conn.execute("DELETE FROM users WHERE id=?", (user_id,))
+        conn.execute("DELETE FROM repayments WHERE user_id=?", (user_id,))
+    run_write(_delete, DB_NAME)
+    invalidate_users(user_id)
 
 # ----------------------
 # REPAYMENT FUNCTIONS
 # ----------------------
-def generate_repayment_schedule(user_id, loan_amount, duration):
-    conn = _get_conn()
-    c = conn.cursor()
+# One installment per day for `duration` days, starting the day after
+# registration, generated inside SQLite in a single statement. Due dates
+# are Unix timestamps (repayments.due_ts).
+SCHEDULE_INSERT_SQL = """
+    WITH RECURSIVE days(n) AS (
+        SELECT 1 UNION ALL SELECT n + 1 FROM days WHERE n < ?
+    )
+    INSERT INTO repayments (user_id, amount, due_ts, updated_at, change_seq)
+    SELECT ?, ?, ? + n * 86400, ?, ?
+    FROM days WHERE n <= ?
+"""
+
+def _insert_repayment_schedule(conn, user_id, loan_amount, duration):
     installment_amount = round(loan_amount / duration, 2) if duration > 0 else 0
-    today = datetime.now()
-    for i in range(duration):
-        due_date = (today + timedelta(days=i+1)).strftime("%Y-%m-%d %H:%M:%S")
-        c.execute("INSERT INTO repayments (user_id, amount, due_date) VALUES (?, ?, ?)", (user_id, installment_amount, due_date))
-    conn.commit()
-    conn.close()
+    now = int(time.time())
+    conn.execute(SCHEDULE_INSERT_SQL, (duration, user_id, installment_amount, now, now, next_change_seq(conn), duration))
+
+def generate_repayment_schedule(user_id, loan_amount, duration):
+    run_write(lambda conn: _insert_repayment_schedule(conn, user_id, loan_amount, duration), DB_NAME)
+    invalidate_users(user_id)
 
 def get_repayments_by_user(user_id):
-    conn = _get_conn()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM repayments WHERE user_id=? ORDER BY due_date ASC", (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    rows = _get_conn().execute("SELECT * FROM repayments WHERE user_id=? ORDER BY due_ts ASC", (user_id,)).fetchall()
     return [dict(r) for r in rows]
 
+def get_recent_repayments(user_id, limit=5):
+    """The user's last `limit` installments, oldest first."""
+    rows = _get_conn().execute("""
+        SELECT date(due_ts, 'unixepoch', 'localtime') AS due_day, amount, paid FROM repayments
+        WHERE user_id=? ORDER BY due_ts DESC, id DESC LIMIT ?
+    """, (user_id, limit)).fetchall()
+    return [dict(r) for r in reversed(rows)]
+
+def _mark_paid(conn, repayment_id):
+    conn.execute("UPDATE repayments SET paid=1 WHERE id=?", (repayment_id,))
+    row = conn.execute("SELECT user_id FROM repayments WHERE id=?", (repayment_id,)).fetchone()
+    return row["user_id"] if row else None
+
 def mark_repayment_as_paid(repayment_id):
-    conn = _get_conn()
-    c = conn.cursor()
-    c.execute("UPDATE repayments SET paid=1 WHERE id=?", (repayment_id,))
-    conn.commit()
-    conn.close()
+    user_id = run_write(lambda conn: _mark_paid(conn, repayment_id), DB_NAME)
+    if user_id is not None:
+        invalidate_users(user_id)
 
 def compute_user_paid_and_remaining(user):
     repayments = get_repayments_by_user(user['id'])
@@ -190,83 +154,106 @@ def compute_user_paid_and_remaining(user):
 # ----------------------
 # USSD SESSIONS HELPERS
 # ----------------------
+# In-progress registrations live in the session store (see
+# session_store.py for the backends); only completed registrations hit disk.
+USSD_SESSIONS = create_session_store()
+
 def get_ussd_session(session_id):
-    conn = _get_conn()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM ussd_sessions WHERE session_id=?", (session_id,))
-    row = c.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    return USSD_SESSIONS.get(session_id)
 
 def upsert_ussd_session(session_id, phone=None, step=None, **kwargs):
-    conn = _get_conn()
-    c = conn.cursor()
-    existing = c.execute("SELECT session_id FROM ussd_sessions WHERE session_id=?", (session_id,)).fetchone()
-    if existing:
-        fields = []
-        values = []
-        if phone is not None:
-            fields.append("phone=?"); values.append(phone)
-        if step is not None:
-            fields.append("step=?"); values.append(step)
-        for k, v in kwargs.items():
-            if k in ("national_id", "full_name", "address", "father_name", "mother_name", "loan_amount"):
-                fields.append(f"{k}=?"); values.append(v)
-        if fields:
-            sql = "UPDATE ussd_sessions SET " + ", ".join(fields) + " WHERE session_id=?"
-            values.append(session_id)
-            c.execute(sql, tuple(values))
-    else:
-        columns = ["session_id"]
-        placeholders = ["?"]
-        values = [session_id]
-        if phone is not None:
-            columns.append("phone"); placeholders.append("?"); values.append(phone)
-        if step is not None:
-            columns.append("step"); placeholders.append("?"); values.append(step)
-        for k, v in kwargs.items():
-            if k in ("national_id", "full_name", "address", "father_name", "mother_name", "loan_amount"):
-                columns.append(k); placeholders.append("?"); values.append(v)
-        sql = f"INSERT INTO ussd_sessions ({', '.join(columns)}) VALUES ({', '.join(placeholders)})"
-        c.execute(sql, tuple(values))
-    conn.commit()
-    conn.close()
+    USSD_SESSIONS.upsert(session_id, phone=phone, step=step, **kwargs)
 
 def clear_ussd_session(session_id):
-    conn = _get_conn()
-    c = conn.cursor()
-    c.execute("DELETE FROM ussd_sessions WHERE session_id=?", (session_id,))
-    conn.commit()
-    conn.close()
+    USSD_SESSIONS.clear(session_id)
+
+# ----------------------
+# REGISTRATION
+# ----------------------
+def register_user(session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration):
+    """Register a borrower with their repayment schedule in one transaction.
+
+    The duplicate-phone check, the user row, the whole schedule and the
+    session cleanup commit together, so a crash never leaves a user without
+    a schedule. Returns (user_id, existing_user); existing_user is set, and
+    nothing is written, when the phone is already registered.
+    """
+    def _register(conn):
+        existing = conn.execute("SELECT * FROM users WHERE phone=?", (phone,)).fetchone()
+        if existing:
+            USSD_SESSIONS.clear(session_id, conn=conn)
+            return None, dict(existing)
+        user_id = _insert_user(conn, session_id, phone, national_id, full_name, address,
+                               father_name, mother_name, loan_amount, duration)
+        _insert_repayment_schedule(conn, user_id, loan_amount, duration)
+        USSD_SESSIONS.clear(session_id, conn=conn)
+        return user_id, None
+    user_id, existing_user = run_write(_register, DB_NAME)
+    if user_id is not None:
+        invalidate_phones(phone)
+    return user_id, existing_user
 
 # ----------------------
 # DASHBOARD SUMMARY
 # ----------------------
-def get_dashboard_summary():
-    conn = _get_conn()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users = c.fetchone()[0]
-    c.execute("SELECT SUM(loan_amount) FROM users")
-    total_loans = c.fetchone()[0] or 0
-    c.execute("""
-        SELECT COUNT(*) FROM users u
-        WHERE NOT EXISTS (
-            SELECT 1 FROM repayments r
-            WHERE r.user_id = u.id AND r.paid != 1
-        )
-    """)
-    completed_users = c.fetchone()[0]
-    in_progress = total_users - completed_users
-    conn.close()
+def get_dashboard_summary(db_name=DB_NAME):
+    # Single-row read: the counters are maintained by triggers (migration 5).
+    row = get_conn(db_name).execute("""
+        SELECT total_users, total_loans, completed_users, outstanding_balance
+        FROM portfolio_summary WHERE id = 1
+    """).fetchone()
     return {
-        "total_users": total_users,
-        "total_loans": round(total_loans, 2),
-        "completed_users": completed_users,
-        "in_progress": in_progress
+        "total_users": row["total_users"],
+        "total_loans": round(row["total_loans"], 2),
+        "completed_users": row["completed_users"],
+        "in_progress": row["total_users"] - row["completed_users"],
+        "outstanding_balance": round(row["outstanding_balance"], 2)
     }
 
+# ----------------------
+# DASHBOARD ROWS
+# ----------------------
+# One page of users (best search matches first) with their repayment
+# totals. The page is cut from users first, so only that page's repayments
+# are aggregated and the cost does not grow with the number of borrowers.
+DASHBOARD_PAGE_SQL = """
+    WITH page AS (
+        SELECT users.*, {rank} AS search_rank
+        FROM {source}
+        ORDER BY search_rank, users.id
+        LIMIT ? OFFSET ?
+    ),
+    totals AS (
+        SELECT page.*,
+               COALESCE(SUM(CASE WHEN r.paid = 1 THEN r.amount END), 0) AS paid_sum,
+               MIN(CASE WHEN r.paid = 0 THEN r.due_ts END) AS next_due
+        FROM page
+        LEFT JOIN repayments r ON r.user_id = page.id
+        GROUP BY page.id
+    )
+    SELECT totals.*,
+           ROUND(paid_sum, 2) AS total_paid,
+           ROUND(COALESCE(loan_amount, 0) - paid_sum, 2) AS remaining,
+           CASE WHEN next_due IS NULL THEN 0
+                ELSE MAX(next_due - ?, 0)
+           END AS countdown_seconds,
+           CASE WHEN next_due IS NULL THEN 'Completed'
+                WHEN next_due < ? THEN 'Overdue'
+                ELSE 'In Progress'
+           END AS status
+    FROM totals
+    ORDER BY search_rank, id
+"""
+
+def get_dashboard_page(search="", page=1, per_page=5, db_name=DB_NAME):
+    """Return (rows, total_matching_users) for one dashboard page."""
+    source, rank, params = user_search.user_search_source(search, db_name)
+    now = int(time.time())
+    total = user_search.count_users(search, db_name)
+    rows = get_conn(db_name).execute(DASHBOARD_PAGE_SQL.format(source=source, rank=rank),
+                               params + (per_page, (page - 1) * per_page, now, now)).fetchall()
+    return [dict(r) for r in rows], total
+
 # ----------------------
 # ADMIN ROUTES
 # ----------------------
@@ -293,31 +280,13 @@ def dashboard():
         return redirect(url_for("login"))
 
     search = request.args.get("search", "")
-    all_users = search_users(search)
-    # compute totals per user for display
-    today = datetime.now()
-    for u in all_users:
-        repayments = get_repayments_by_user(u['id'])
-        total_paid = sum(r['amount'] for r in repayments if r.get('paid') == 1)
-        u['total_paid'] = round(total_paid, 2)
-        u['remaining'] = round((u.get('loan_amount') or 0) - total_paid, 2)
-        # compute next unpaid countdown seconds
-        next_unpaid = None
-        for r in repayments:
-            if r.get('paid') == 0:
-                due = datetime.strptime(r['due_date'], "%Y-%m-%d %H:%M:%S")
-                if next_unpaid is None or due < next_unpaid:
-                    next_unpaid = due
-        u['countdown_seconds'] = max(int((next_unpaid - today).total_seconds()), 0) if next_unpaid else 0
-
-    page = int(request.args.get("page", 1))
+    page = max(int(request.args.get("page", 1)), 1)
     per_page = 5
-    total = len(all_users)
-    start = (page - 1) * per_page
-    end = start + per_page
-    rows = all_users[start:end]
+    # Read from the report snapshot when one is configured (snapshot.py).
+    db_name = snapshot_db()
+    rows, total = get_dashboard_page(search, page, per_page, db_name)
 
-    summary = get_dashboard_summary()
+    summary = get_dashboard_summary(db_name)
 
     return render_template("dashboard.html",
                            summary=summary,
@@ -329,165 +298,158 @@ def dashboard():
 # ----------------------
 # USSD ROUTE
 # ----------------------
+# The menu, registration states and replies are defined in ussd_menu.json
+# (see ussd_menu.py); the handler below only dispatches on them.
+USSD_CONTENT_TYPE = "text/plain; charset=utf-8"
+
+def _ussd_reply(payload):
+    return Response(payload, content_type=USSD_CONTENT_TYPE)
+
+def _ussd_complete_registration(session_id, phone_number, answers):
+    # ussd_menu checked at load time that every state stores a register_user argument.
+    user_id, existing_user = register_user(session_id, phone_number,
+                                           **{field: answers.get(field) for field in ussd_menu.USER_FIELDS})
+    if existing_user:
+        return _ussd_reply(ussd_menu.message("already_registered", full_name=existing_user["full_name"]))
+    return _ussd_reply(ussd_menu.message("registered"))
+
+def _ussd_register_single(session_id, phone_number, text):
+    # "1*id*name*address*father*mother*amount*duration" in one request.
+    values = text.split("*")[1:]
+    try:
+        answers = {state.field: state.validate(value) for state, value in zip(ussd_menu.REGISTRATION_STATES, values)}
+    except ValueError:
+        return _ussd_reply(ussd_menu.message("invalid_registration"))
+    return _ussd_complete_registration(session_id, phone_number, answers)
+
+def _ussd_register_step(session_id, phone_number, text, sess):
+    try:
+        number = int(sess.get("step", ussd_menu.FIRST_STATE))
+    except (TypeError, ValueError):
+        number = ussd_menu.FIRST_STATE
+    state = ussd_menu.STATES.get(number)
+    if state is None:
+        clear_ussd_session(session_id)
+        return _ussd_reply(ussd_menu.message("invalid_state"))
+    g.ussd_step = f"register:{state.field}"
+    try:
+        value = state.validate(text.rpartition("*")[2].strip())
+    except ValueError:
+        clear_ussd_session(session_id)
+        return _ussd_reply(ussd_menu.message(state.invalid))
+    if state.next != "complete":
+        upsert_ussd_session(session_id, step=state.next, **{state.field: value})
+        return _ussd_reply(ussd_menu.STATES[state.next].prompt)
+    answers = dict(sess, **{state.field: value})
+    if not all(answers.get(s.field) for s in ussd_menu.REGISTRATION_STATES if s is not state):
+        clear_ussd_session(session_id)
+        return _ussd_reply(ussd_menu.message("missing_data"))
+    return _ussd_complete_registration(session_id, phone_number, answers)
+
+# Check Loan and View Repayments replies are rendered once per registered
+# phone and kept in ussd_cache.READ_CACHE until a write touches that
+# borrower.
+def _render_loan_summary(phone_number):
+    user = get_user_by_phone(phone_number)
+    if not user:
+        return None, ussd_menu.message("not_registered")
+    return user["id"], ussd_menu.message("loan_summary", full_name=user["full_name"],
+                                         loan_amount=user["loan_amount"], duration=user["duration"])
+
+def _render_recent_repayments(phone_number):
+    user = get_user_by_phone(phone_number)
+    if not user:
+        return None, ussd_menu.message("not_registered")
+    repayments = get_recent_repayments(user["id"])
+    if not repayments:
+        return user["id"], ussd_menu.message("no_schedule")
+    lines = [ussd_menu.MESSAGES["repayments_header"]]
+    for r in repayments:
+        lines.append(ussd_menu.MESSAGES["repayment_line"].format(
+            date=r["due_day"], amount=r["amount"], status="Paid" if r["paid"] else "Unpaid"))
+    return user["id"], "\n".join(lines).encode()
+
+def _ussd_cached(kind, render, phone_number):
+    # Catch up with writes made by other processes first.
+    READ_CACHE.sync(_get_conn())
+    payload = READ_CACHE.get(phone_number, kind)
+    if payload is None:
+        generation = READ_CACHE.generation
+        user_id, payload = render(phone_number)
+        READ_CACHE.put(phone_number, kind, user_id, payload, generation)
+    return _ussd_reply(payload)
+
+# Menu actions other than "register", by the name used in ussd_menu.json.
+USSD_ACTIONS = {
+    "check_loan": lambda phone_number: _ussd_cached("check_loan", _render_loan_summary, phone_number),
+    "view_repayments": lambda phone_number: _ussd_cached("view_repayments", _render_recent_repayments, phone_number),
+}
+_unknown_actions = set(ussd_menu.OPTIONS.values()) - set(USSD_ACTIONS) - {"register"}
+if _unknown_actions:
+    raise ValueError(f"ussd_menu.json names unknown actions: {', '.join(sorted(_unknown_actions))}")
+
+def _ussd_answer(session_id, phone_number, text):
+    # Main menu
+    if not text:
+        g.ussd_step = "menu"
+        return _ussd_reply(ussd_menu.MENU_PROMPT)
+
+    choice, _, rest = text.partition("*")
+    action = ussd_menu.OPTIONS.get(choice)
+    if action == "register":
+        if text.count("*") >= len(ussd_menu.REGISTRATION_STATES):
+            g.ussd_step = "register:single"
+            return _ussd_register_single(session_id, phone_number, text)
+        if not rest:
+            g.ussd_step = "register"
+            upsert_ussd_session(session_id, phone=phone_number, step=ussd_menu.FIRST_STATE)
+            return _ussd_reply(ussd_menu.STATES[ussd_menu.FIRST_STATE].prompt)
+
+    # An open registration session takes every answer, whatever it starts with.
+    sess = get_ussd_session(session_id)
+    if sess:
+        return _ussd_register_step(session_id, phone_number, text, sess)
+
+    handler = USSD_ACTIONS.get(action)
+    if handler is None:
+        return _ussd_reply(ussd_menu.message("invalid_choice"))
+    g.ussd_step = action
+    return handler(phone_number)
+
 @app.route("/ussd", methods=["POST"])
 def ussd():
     """
     Supports:
      - Single-request registration where provider sends all fields in one text: "1*id*name*address*father*mother*amount*duration"
-     - Step-by-step registration via sessionId using ussd_sessions table.
+     - Step-by-step registration via sessionId using the USSD session store.
+     - Gateway retransmits (same sessionId and text) get the original reply again.
     """
     session_id = request.form.get("sessionId") or request.form.get("session_id") or ""
     phone_number = request.form.get("phoneNumber") or request.form.get("phone") or ""
     text = request.form.get("text", "") or ""
 
-    user_response = text.split("*") if text else []
-    response_text = ""
-
-    # Main menu
-    if text == "" or text is None:
-        response_text = "CON Welcome to USSD Loan Service\n1. Register\n2. Check Loan\n3. View Repayments"
-        return Response(response_text, mimetype="text/plain")
-
-    # If user sent a single combined registration in one request (len >= 8)
-    if user_response and user_response[0] == "1" and len(user_response) >= 8:
-        try:
-            national_id = user_response[1].strip()
-            full_name = user_response[2].strip()
-            address = user_response[3].strip()
-            father_name = user_response[4].strip()
-            mother_name = user_response[5].strip()
-            loan_amount = float(user_response[6])
-            duration = int(user_response[7])
-        except Exception:
-            response_text = "END Invalid registration data. Please try again."
-            return Response(response_text, mimetype="text/plain")
-
-        existing_user = get_user_by_phone(phone_number)
-        if existing_user:
-            response_text = f"END You are already registered, {existing_user['full_name']}."
-            return Response(response_text, mimetype="text/plain")
-
-        user_id = add_user(session_id, phone_number, national_id, full_name, address, father_name, mother_name, loan_amount, duration)
-        generate_repayment_schedule(user_id, loan_amount, duration)
-        clear_ussd_session(session_id)
-        response_text = "END ✅ Registration successful! You will receive SMS confirmation."
-        return Response(response_text, mimetype="text/plain")
-
-    # Otherwise treat as step-by-step using ussd_sessions
-    sess = get_ussd_session(session_id) or {}
-    step = sess.get("step", 0)
-
-    if user_response and user_response[0] == "1" and len(user_response) == 1:
-        upsert_ussd_session(session_id, phone=phone_number, step=1)
-        response_text = "CON Enter your National ID:"
-        return Response(response_text, mimetype="text/plain")
-
-    if sess:
-        last_answer = user_response[-1].strip() if user_response else ""
-        try:
-            step = int(sess.get("step", 1))
-        except Exception:
-            step = 1
-
-        if step == 1:
-            upsert_ussd_session(session_id, national_id=last_answer, step=2)
-            response_text = "CON Enter your Full Name:"
-            return Response(response_text, mimetype="text/plain")
-        elif step == 2:
-            upsert_ussd_session(session_id, full_name=last_answer, step=3)
-            response_text = "CON Enter your Address (village, cell, sector):"
-            return Response(response_text, mimetype="text/plain")
-        elif step == 3:
-            upsert_ussd_session(session_id, address=last_answer, step=4)
-            response_text = "CON Enter your Father's Name:"
-            return Response(response_text, mimetype="text/plain")
-        elif step == 4:
-            upsert_ussd_session(session_id, father_name=last_answer, step=5)
-            response_text = "CON Enter your Mother's Name:"
-            return Response(response_text, mimetype="text/plain")
-        elif step == 5:
-            upsert_ussd_session(session_id, mother_name=last_answer, step=6)
-            response_text = "CON Enter desired Loan Amount (RWF):"
-            return Response(response_text, mimetype="text/plain")
-        elif step == 6:
-            try:
-                loan_amount = float(last_answer)
-            except Exception:
-                response_text = "END Invalid amount. Session cancelled."
-                clear_ussd_session(session_id)
-                return Response(response_text, mimetype="text/plain")
-            upsert_ussd_session(session_id, loan_amount=loan_amount, step=7)
-            response_text = "CON Enter loan duration (in days):"
-            return Response(response_text, mimetype="text/plain")
-        elif step == 7:
-            try:
-                duration = int(last_answer)
-            except Exception:
-                response_text = "END Invalid duration. Session cancelled."
-                clear_ussd_session(session_id)
-                return Response(response_text, mimetype="text/plain")
-            s = get_ussd_session(session_id)
-            if not s:
-                response_text = "END Session expired. Please start again."
-                return Response(response_text, mimetype="text/plain")
-            national_id = s.get("national_id")
-            full_name = s.get("full_name")
-            address = s.get("address")
-            father_name = s.get("father_name")
-            mother_name = s.get("mother_name")
-            loan_amount = s.get("loan_amount")
-            if not all([national_id, full_name, address, father_name, mother_name, loan_amount]):
-                response_text = "END Missing data in your session. Please start again."
-                clear_ussd_session(session_id)
-                return Response(response_text, mimetype="text/plain")
-            existing_user = get_user_by_phone(phone_number)
-            if existing_user:
-                response_text = f"END You are already registered, {existing_user['full_name']}."
-                clear_ussd_session(session_id)
-                return Response(response_text, mimetype="text/plain")
-            user_id = add_user(session_id, phone_number, national_id, full_name, address, father_name, mother_name, float(loan_amount), duration)
-            generate_repayment_schedule(user_id, float(loan_amount), duration)
-            clear_ussd_session(session_id)
-            response_text = "END ✅ Registration successful! You will receive SMS confirmation."
-            return Response(response_text, mimetype="text/plain")
-        else:
-            response_text = "END Invalid session state. Please start again."
-            clear_ussd_session(session_id)
-            return Response(response_text, mimetype="text/plain")
-
-    # Check loan (option 2)
-    if user_response and user_response[0] == "2":
-        user = get_user_by_phone(phone_number)
-        if not user:
-            response_text = "END You are not registered yet."
-        else:
-            response_text = f"END Hello {user['full_name']}, Loan Amount: RWF {user['loan_amount']}, Duration: {user['duration']} days"
-        return Response(response_text, mimetype="text/plain")
-
-    # View repayments (option 3)
-    if user_response and user_response[0] == "3":
-        user = get_user_by_phone(phone_number)
-        if not user:
-            response_text = "END You are not registered yet."
-        else:
-            repayments = get_repayments_by_user(user["id"])
-            if not repayments:
-                response_text = "END No repayment schedule found."
-            else:
-                lines = []
-                for r in repayments[-5:]:
-                    status = "Paid" if r["paid"] else "Unpaid"
-                    lines.append(f"{r['due_date'].split()[0]}: RWF {r['amount']} - {status}")
-                response_text = "END Last repayments:\n" + "\n".join(lines)
-        return Response(response_text, mimetype="text/plain")
-
-    # Fallback
-    response_text = "END Invalid choice or format. Please try again."
-    return Response(response_text, mimetype="text/plain")
+    if not session_id:
+        return _ussd_answer(session_id, phone_number, text)
+    payload = REPLY_CACHE.begin(session_id, text)
+    if payload is not None:
+        g.ussd_step = "retransmit"
+        return _ussd_reply(payload)
+    try:
+        response = _ussd_answer(session_id, phone_number, text)
+    except BaseException:
+        REPLY_CACHE.abandon(session_id, text)
+        raise
+    REPLY_CACHE.finish(session_id, text, response.get_data())
+    return response
 
 # ----------------------
 # USER DETAILS & REPAYMENTS
 # ----------------------
+@app.template_filter("local_datetime")
+def local_datetime(timestamp):
+    # Due dates are stored as Unix timestamps and only formatted here.
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") if timestamp is not None else ""
+
 @app.route("/user/<int:user_id>")
 def user_details(user_id):
     if "admin" not in session:
@@ -499,16 +461,15 @@ def user_details(user_id):
         return redirect(url_for("dashboard"))
 
     repayments = get_repayments_by_user(user_id)
-    today = datetime.now()
+    now = int(time.time())
     for r in repayments:
-        due_date = datetime.strptime(r["due_date"], "%Y-%m-%d %H:%M:%S")
-        delta = due_date - today
+        seconds_left = r["due_ts"] - now
         # readable remaining string
-        if delta.total_seconds() < 0:
-            remaining_text = f"{abs(delta.days)} days ago"
+        if seconds_left < 0:
+            remaining_text = f"{abs(seconds_left // 86400)} days ago"
             status_override = "Overdue" if r.get("paid") == 0 else "Paid"
         else:
-            remaining_text = f"{delta.days} days"
+            remaining_text = f"{seconds_left // 86400} days"
             status_override = "Paid" if r.get("paid") == 1 else "Unpaid"
 
         r["remaining_time"] = remaining_text
@@ -536,12 +497,11 @@ def view_repayments(user_id):
         flash("User not found", "error")
         return redirect(url_for("dashboard"))
     repayments = get_repayments_by_user(user_id)
-    today = datetime.now()
+    now = int(time.time())
     for r in repayments:
-        due_date = datetime.strptime(r["due_date"], "%Y-%m-%d %H:%M:%S")
-        delta = due_date - today
-        r["remaining_time"] = f"{delta.days} days" if delta.total_seconds() >= 0 else f"{abs(delta.days)} days ago"
-        r["status"] = "Paid" if r.get("paid") == 1 else ("Overdue" if delta.total_seconds() < 0 else "Unpaid")
+        seconds_left = r["due_ts"] - now
+        r["remaining_time"] = f"{seconds_left // 86400} days" if seconds_left >= 0 else f"{abs(seconds_left // 86400)} days ago"
+        r["status"] = "Paid" if r.get("paid") == 1 else ("Overdue" if seconds_left < 0 else "Unpaid")
     return render_template("repayments.html", user=user, repayments=repayments)
 
 # ----------------------
@@ -592,28 +552,90 @@ def delete_user_route(user_id):
 # ----------------------
 # EXPORT USERS
 # ----------------------
+# Rows are streamed in chunks, so memory stays flat however many users
+# there are. Each chunk is its own short query that picks up after the last
+# id sent, so no statement (and no read lock on users.db) stays open while
+# the client downloads. ?since= limits the export to users changed since
+# then (updated_at, migration 8); with totals, a user whose repayments
+# changed counts as changed.
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_HEADER = [
+    "ID", "Session ID", "Phone", "National ID", "Full Name",
+    "Address", "Father", "Mother", "Loan Amount", "Duration", "Date Registered"
+]
+EXPORT_SQL = """
+    SELECT id, session_id, phone, national_id, full_name,
+           address, father_name, mother_name, loan_amount, duration, date_registered
+    FROM users u WHERE u.id > :after {where} ORDER BY u.id LIMIT :limit
+"""
+EXPORT_SINCE_WHERE = "AND u.updated_at >= :since"
+EXPORT_WITH_TOTALS_SINCE_WHERE = """
+    AND (u.updated_at >= :since OR u.id IN (SELECT user_id FROM repayments WHERE updated_at >= :since))
+"""
+EXPORT_WITH_TOTALS_SQL = """
+    SELECT id, session_id, phone, national_id, full_name,
+           address, father_name, mother_name, loan_amount, duration, date_registered,
+           ROUND(total_paid, 2), ROUND(COALESCE(loan_amount, 0) - total_paid, 2)
+    FROM (
+        SELECT u.*,
+               -- The unary + keeps the planner off idx_repayments_paid_due,
+               -- which would scan every paid installment once per user.
+               (SELECT COALESCE(SUM(r.amount), 0) FROM repayments r
+                WHERE r.user_id = u.id AND +r.paid = 1) AS total_paid
+        FROM users u WHERE u.id > :after {where} ORDER BY u.id LIMIT :limit
+    )
+    ORDER BY id
+"""
+
+def _export_csv_chunks(with_totals=False, since=None):
+    started = time.perf_counter()
+    written = 0
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_HEADER + (["Total Paid", "Remaining"] if with_totals else []))
+    sql, where = (EXPORT_WITH_TOTALS_SQL, EXPORT_WITH_TOTALS_SINCE_WHERE) if with_totals else (EXPORT_SQL, EXPORT_SINCE_WHERE)
+    sql = sql.format(where="" if since is None else where)
+    params = {"after": 0, "since": since, "limit": EXPORT_CHUNK_ROWS}
+    # Reads the report snapshot when one is configured (snapshot.py).
+    db_name = snapshot_db()
+    while True:
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+        rows = get_conn(db_name).execute(sql, params).fetchall()
+        if not rows:
+            break
+        writer.writerows(rows)
+        written += len(rows)
+        params["after"] = rows[-1][0]
+    export = "csv_totals" if with_totals else "csv"
+    metrics.EXPORT_DURATION.observe(time.perf_counter() - started, export=export)
+    metrics.EXPORT_ROWS.inc(written, export=export)
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 @app.route("/export")
 def export_users():
-    users = search_users()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        "ID", "Session ID", "Phone", "National ID", "Full Name",
-        "Address", "Father", "Mother", "Loan Amount", "Duration", "Date Registered"
-    ])
-    for u in users:
-        writer.writerow([
-            u["id"], u["session_id"], u["phone"], u["national_id"], u["full_name"],
-            u["address"], u["father_name"], u["mother_name"], u["loan_amount"], u["duration"],
-            u.get("date_registered", "")
-        ])
-    output.seek(0)
-    return send_file(
-        io.BytesIO(output.getvalue().encode()),
-        mimetype="text/csv",
-        as_attachment=True,
-        download_name="users_export.csv"
-    )
+    # ?totals=1 appends each user's paid total and remaining balance.
+    with_totals = request.args.get("totals") == "1"
+    since = request.args.get("since")
+    if since:
+        try:
+            since = parse_since(since)
+        except ValueError:
+            return Response("Invalid 'since': use Unix seconds or YYYY-MM-DD[ HH:MM:SS]", status=400, mimetype="text/plain")
+    body = _export_csv_chunks(with_totals, since or None)
+    headers = {"Content-Disposition": "attachment; filename=users_export.csv", "Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        body = _gzip_chunks(body)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, mimetype="text/csv", headers=headers)
 
 # ----------------------
 # RUN APP
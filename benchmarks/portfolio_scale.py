@@ -0,0 +1,205 @@
+"""Admin and batch path scale benchmark.
+
+Builds synthetic portfolios (see synthetic_portfolio.py) of increasing
+size and times the dashboard queries, user search, the /export CSV, the
+Excel export and the auto deduction job on each, then reports how every
+operation grows with the number of borrowers:
+
+    python benchmarks/portfolio_scale.py
+    python benchmarks/portfolio_scale.py --sizes 10000,100000 --skip export_to_excel --output scale.json
+
+Each size runs in its own process, because db_pool fixes the database
+path at import time. Generated databases are kept in --keep (when given)
+and reused by later runs with the same size and seed; the benchmark
+itself always works on a copy, since auto deduction marks repayments paid.
+
+The growth column is the exponent k in time ~ borrowers^k between the two
+largest sizes: about 0 means the operation does not depend on portfolio
+size, about 1 means it is linear in it.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic_portfolio import DEFAULT_MIX, LAST_NAMES, borrower_phone
+from ussd_load import git_revision
+
+DEFAULT_SIZES = "10000,100000,1000000"
+OPERATIONS = ("get_dashboard_summary", "dashboard", "dashboard:last_page", "dashboard:search", "search_users",
+              "search_users:phone", "export_csv", "export_csv_totals", "export_to_excel",
+              "auto_deduct_repayments:catch_up", "auto_deduct_repayments")
+# Operations timed once: they write files or change the data.
+SINGLE_RUN = ("export_to_excel", "auto_deduct_repayments:catch_up", "auto_deduct_repayments")
+
+# -------------------
+# OPERATIONS
+# -------------------
+def _operations(users, work_dir):
+    """Return {name: callable} for one portfolio; each call returns rows handled."""
+    import app
+    import scheduler
+    from export_data import export_to_excel
+
+    client = app.app.test_client()
+    last_page = max((users + 4) // 5, 1)
+
+    def _export(path):
+        response = client.get(path)
+        body = response.get_data()
+        return body.count(b"\n") - 1
+
+    def _export_to_excel():
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            files = export_to_excel()
+        finally:
+            os.chdir(cwd)
+        for f in files:
+            os.remove(os.path.join(work_dir, f))
+        return len(files)
+
+    def _deduct():
+        scheduler.auto_deduct_repayments()
+        return 0
+
+    return {
+        "get_dashboard_summary": lambda: app.get_dashboard_summary()["total_users"],
+        "dashboard": lambda: len(app.get_dashboard_page("", 1)[0]) + bool(app.get_dashboard_summary()),
+        "dashboard:last_page": lambda: len(app.get_dashboard_page("", last_page)[0]),
+        "dashboard:search": lambda: len(app.get_dashboard_page(LAST_NAMES[0], 1)[0]),
+        # Matches about one borrower in len(LAST_NAMES).
+        "search_users": lambda: len(app.search_users(LAST_NAMES[0])),
+        "search_users:phone": lambda: len(app.search_users(borrower_phone(users // 2)[-7:])),
+        "export_csv": lambda: _export("/export"),
+        "export_csv_totals": lambda: _export("/export?totals=1"),
+        "export_to_excel": _export_to_excel,
+        # The first run settles the whole overdue backlog, the next one only
+        # what fell due in between: its steady-state cost.
+        "auto_deduct_repayments:catch_up": _deduct,
+        "auto_deduct_repayments": _deduct,
+    }
+
+def run_worker(users, repeat, skip, result_path):
+    """Time every operation against USSD_DB_PATH and write the results as JSON."""
+    work_dir = tempfile.mkdtemp(prefix="ussd_scale_")
+    operations = _operations(users, work_dir)
+    results = {}
+    for name in OPERATIONS:
+        if name in skip or name.split(":")[0] in skip:
+            continue
+        timings = []
+        for _ in range(1 if name in SINGLE_RUN else repeat):
+            started = time.perf_counter()
+            rows = operations[name]()
+            timings.append(time.perf_counter() - started)
+        results[name] = {"seconds": round(statistics.median(timings), 6), "rows": rows, "runs": len(timings)}
+        print(f"  {name:<34}{results[name]['seconds'] * 1000:>12.1f} ms")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    with open(result_path, "w") as f:
+        json.dump(results, f)
+
+# -------------------
+# DRIVER
+# -------------------
+def prepare_database(users, seed, mix, keep_dir, work_dir):
+    """Return the path of a fresh working copy of the portfolio for `users`."""
+    db_path = os.path.join(work_dir, f"portfolio_{users}.db")
+    if keep_dir:
+        os.makedirs(keep_dir, exist_ok=True)
+        kept = os.path.join(keep_dir, f"portfolio_{users}_seed{seed}.db")
+        if not os.path.exists(kept):
+            _generate(users, seed, mix, kept)
+        shutil.copyfile(kept, db_path)
+    else:
+        _generate(users, seed, mix, db_path)
+    return db_path
+
+def _generate(users, seed, mix, db_path):
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "synthetic_portfolio.py"),
+                    db_path, "--users", str(users), "--seed", str(seed), "--mix", mix], check=True)
+
+def growth(sizes, seconds):
+    """Exponent k in seconds ~ size^k between the two largest sizes."""
+    points = [(n, s) for n, s in zip(sizes, seconds) if s]
+    if len(points) < 2:
+        return None
+    (n1, s1), (n2, s2) = points[-2:]
+    return round(math.log(s2 / s1) / math.log(n2 / n1), 2)
+
+def print_report(result):
+    sizes = result["sizes"]
+    print(f"\n{'operation':<34}" + "".join(f"{n:>12}" for n in sizes) + f"{'growth':>9}")
+    for name, row in result["operations"].items():
+        cells = "".join(f"{s * 1000:>10.1f}ms" if s is not None else f"{'-':>12}" for s in row["seconds"])
+        k = row["growth"]
+        print(f"{name:<34}{cells}{k if k is not None else '-':>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time admin and batch paths on synthetic portfolios")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Portfolio sizes (borrowers) to benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the portfolios')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Loan state weights passed to the generator')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per read-only operation (median is reported)')
+    parser.add_argument('--skip', default="", help='Comma-separated operations to leave out, e.g. export_to_excel')
+    parser.add_argument('--keep', help='Directory to keep generated databases in and reuse them from')
+    parser.add_argument('--output', help='Write the JSON results here')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--worker_users', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    skip = {s for s in args.skip.split(",") if s}
+
+    if args.worker:
+        run_worker(args.worker_users, args.repeat, skip, args.worker)
+        sys.exit(0)
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    work_dir = tempfile.mkdtemp(prefix="ussd_scale_")
+    per_size = {}
+    try:
+        for users in sizes:
+            print(f"\n=== {users} borrowers ===")
+            db_path = prepare_database(users, args.seed, args.mix, args.keep, work_dir)
+            result_path = os.path.join(work_dir, f"result_{users}.json")
+            # Each size in a fresh process, pointed at its own database.
+            env = dict(os.environ, USSD_DB_PATH=db_path)
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", result_path,
+                            "--worker_users", str(users), "--repeat", str(args.repeat), "--skip", args.skip],
+                           env=env, check=True)
+            with open(result_path) as f:
+                per_size[users] = json.load(f)
+            os.remove(db_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    operations = {}
+    for name in OPERATIONS:
+        seconds = [per_size[n].get(name, {}).get("seconds") for n in sizes]
+        if any(s is not None for s in seconds):
+            operations[name] = {"seconds": seconds, "growth": growth(sizes, seconds)}
+    result = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "sizes": sizes,
+        "seed": args.seed,
+        "mix": args.mix,
+        "operations": operations,
+        "details": {str(n): per_size[n] for n in sizes},
+    }
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"✅ Results saved to {args.output}")
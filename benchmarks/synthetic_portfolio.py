@@ -0,0 +1,187 @@
+"""Synthetic loan portfolio generator.
+
+Fills an empty database with N borrowers, their daily repayment schedules
+and MoMoPay accounts, so the admin pages, exports and scheduler jobs can
+be measured at production scale:
+
+    python benchmarks/synthetic_portfolio.py portfolio_100k.db --users 100000
+    python benchmarks/synthetic_portfolio.py big.db --users 1000000 --durations 7,30,90 \
+        --mix completed=2,current=5,overdue=2,new=1 --momopay_share 0.5
+
+Every borrower gets a loan state from --mix:
+
+    completed  schedule over and every installment paid
+    current    schedule running, every installment due so far paid
+    overdue    at least one installment that is already due is unpaid
+    new        registered during the last day, nothing due yet
+
+Dates are laid out backwards from --anchor (default: today at midnight),
+so the same --seed and --anchor always produce the same database.
+Borrower i has phone +2507 followed by i on eight digits.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# -------------------
+# DEFAULTS
+# -------------------
+DEFAULT_DURATIONS = (7, 14, 30, 60)
+DEFAULT_MIX = "completed=2,current=5,overdue=2,new=1"
+DEFAULT_MOMOPAY_SHARE = 0.3
+# Borrowers generated and inserted per executemany call.
+CHUNK_USERS = 50000
+
+LOAN_STATES = ("completed", "current", "overdue", "new")
+FIRST_NAMES = ("Jean", "Marie", "Eric", "Aline", "Patrick", "Claudine", "Emmanuel", "Diane", "Olivier",
+               "Grace", "Innocent", "Josiane", "Yves", "Chantal", "David", "Esther", "Theo", "Sandrine")
+LAST_NAMES = ("Habimana", "Uwase", "Niyonzima", "Mukamana", "Nshimiyimana", "Uwimana", "Hakizimana",
+              "Ingabire", "Bizimana", "Mutoni", "Ndayisaba", "Umutoni", "Nsengiyumva", "Iradukunda")
+DISTRICTS = ("Gasabo", "Kicukiro", "Nyarugenge", "Musanze", "Huye", "Rubavu", "Rwamagana", "Muhanga")
+
+SCHEDULE_SQL = """
+    WITH RECURSIVE days(n) AS (
+        SELECT 1 UNION ALL SELECT n + 1 FROM days WHERE n < ?
+    )
+    INSERT INTO repayments (user_id, amount, due_ts, paid, updated_at, change_seq)
+    SELECT users.id, round(users.loan_amount / users.duration, 2),
+           plan.registered_ts + days.n * 86400, days.n <= plan.paid_upto, users.updated_at, users.change_seq
+    FROM temp.seed_plan plan
+    JOIN users ON users.id = plan.user_id
+    JOIN days ON days.n <= users.duration
+"""
+
+def borrower_phone(i):
+    return f"+2507{i:08d}"
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in LOAN_STATES:
+            raise SystemExit(f"Unknown loan state {name!r}; choose from {', '.join(LOAN_STATES)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+def default_anchor():
+    return int(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+# -------------------
+# BORROWERS
+# -------------------
+def _borrower(rng, i, anchor, durations, states, weights):
+    """Return (users row, (registered_ts, paid_upto)) for borrower i."""
+    duration = rng.choice(durations)
+    state = rng.choices(states, weights)[0]
+    if state == "completed":
+        days_ago = duration + rng.randint(1, 60)
+        paid_upto = duration
+    elif state == "current":
+        days_ago = rng.randint(1, max(duration - 1, 1))
+        paid_upto = days_ago
+    elif state == "overdue":
+        days_ago = rng.randint(1, duration + 30)
+        due = min(days_ago, duration)
+        paid_upto = due - rng.randint(1, due)
+    else:
+        days_ago = 0
+        paid_upto = 0
+    # Installment n falls due at registered_ts + n days, so exactly
+    # days_ago installments are due at the anchor.
+    registered_ts = anchor - days_ago * 86400 - rng.randrange(86400)
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    row = (f"seed{i}", borrower_phone(i), f"1{rng.randrange(10 ** 15):015d}", f"{first} {last}",
+           rng.choice(DISTRICTS), f"{rng.choice(FIRST_NAMES)} {last}", f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+           rng.randrange(5, 501) * 1000, duration,
+           datetime.fromtimestamp(registered_ts).strftime("%Y-%m-%d %H:%M:%S"))
+    return row, (registered_ts, paid_upto)
+
+# -------------------
+# GENERATOR
+# -------------------
+def generate_portfolio(users, seed=0, anchor=None, durations=DEFAULT_DURATIONS, mix=DEFAULT_MIX,
+                       momopay_share=DEFAULT_MOMOPAY_SHARE, db_name=None):
+    """Fill an empty database with `users` synthetic borrowers.
+
+    Returns False, without writing anything, when the database already has
+    users. The whole portfolio is written in one transaction.
+    """
+    from bulk_import import IMPORT_CACHE_KIB
+    from db_pool import DB_NAME, run_write
+    from migrations import migrate, next_change_seq, rebuild_portfolio_summary, set_bulk_load
+
+    db_name = db_name or DB_NAME
+    migrate(db_name)
+    anchor = default_anchor() if anchor is None else anchor
+    weights = parse_mix(mix) if isinstance(mix, str) else dict(mix)
+    states = list(weights)
+    state_weights = [weights[s] for s in states]
+    durations = tuple(durations)
+
+    def _generate(conn):
+        if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return False
+        conn.execute(f"PRAGMA cache_size=-{IMPORT_CACHE_KIB}")
+        # The derived tables are rebuilt in one pass at the end instead.
+        set_bulk_load(conn, True)
+        conn.execute("CREATE TEMP TABLE seed_plan (user_id INTEGER PRIMARY KEY, registered_ts INTEGER, paid_upto INTEGER)")
+        # The whole portfolio is one change for the delta exports.
+        seq = next_change_seq(conn)
+
+        rng = random.Random(seed)
+        for start in range(0, users, CHUNK_USERS):
+            rows, plans, accounts = [], [], []
+            for i in range(start, min(start + CHUNK_USERS, users)):
+                row, (registered_ts, paid_upto) = _borrower(rng, i, anchor, durations, states, state_weights)
+                rows.append((i + 1,) + row + (anchor, seq))
+                plans.append((i + 1, registered_ts, paid_upto))
+                if rng.random() < momopay_share:
+                    accounts.append((row[1], rng.randrange(0, 200001)))
+            conn.executemany("""
+                INSERT INTO users (id, session_id, phone, national_id, full_name, address, father_name, mother_name,
+                                   loan_amount, duration, date_registered, updated_at, change_seq)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            conn.executemany("INSERT INTO temp.seed_plan VALUES (?, ?, ?)", plans)
+            conn.executemany("""
+                INSERT OR REPLACE INTO momopays (phone, balance, float_shared, updated_at, change_seq) VALUES (?, ?, 0, ?, ?)
+            """, [account + (anchor, seq) for account in accounts])
+        conn.execute(SCHEDULE_SQL, (max(durations),))
+        conn.execute("DROP TABLE temp.seed_plan")
+
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name='users_fts'").fetchone():
+            conn.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+        rebuild_portfolio_summary(conn)
+        set_bulk_load(conn, False)
+        return True
+
+    started = time.perf_counter()
+    if not run_write(_generate, db_name):
+        print(f"⚠️ {db_name} already has users; nothing generated.")
+        return False
+    print(f"✅ Generated {users} borrowers into {db_name} in {time.perf_counter() - started:.1f}s")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic loan portfolio")
+    parser.add_argument('db', help='Database file to fill (must have no users)')
+    parser.add_argument('--users', type=int, default=10000, help='Borrowers to generate')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--anchor', help='Date the loan states refer to, YYYY-MM-DD (default: today)')
+    parser.add_argument('--durations', default=",".join(map(str, DEFAULT_DURATIONS)), help='Loan durations in days to pick from')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Loan state weights, e.g. ' + DEFAULT_MIX)
+    parser.add_argument('--momopay_share', type=float, default=DEFAULT_MOMOPAY_SHARE, help='Share of borrowers with a MoMoPay account')
+    args = parser.parse_args()
+
+    # db_pool reads USSD_DB_PATH at import time.
+    os.environ["USSD_DB_PATH"] = os.path.abspath(args.db)
+    anchor = int(datetime.strptime(args.anchor, "%Y-%m-%d").timestamp()) if args.anchor else None
+    generate_portfolio(args.users, args.seed, anchor, [int(d) for d in args.durations.split(",")],
+                       args.mix, args.momopay_share)
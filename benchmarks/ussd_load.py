@@ -0,0 +1,256 @@
+"""USSD load benchmark.
+
+Replays a mix of USSD sessions against /ussd and reports throughput and
+p50/p95/p99 latency per menu step.
+
+    python benchmarks/ussd_load.py --users 10000 --sessions 2000 --concurrency 16
+    python benchmarks/ussd_load.py --url http://127.0.0.1:5000/ussd --db bench.db
+
+Without --url the requests go through the Flask test client in this
+process. With --url they go over HTTP to a running server (run_server.py
+or gunicorn) that must have been started with USSD_DB_PATH pointing at
+the same --db, so balance and history lookups find the seeded borrowers.
+
+Results are saved as JSON (--output); pass an earlier file to --compare
+to print the change per step.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic_portfolio import borrower_phone, generate_portfolio
+
+# -------------------
+# SESSION MIXES
+# -------------------
+# Each session is a list of (step label, text) requests sent with the same
+# sessionId and phone, the way the gateway replays cumulative input.
+REGISTRATION_ANSWERS = ["{nid}", "Bench User {n}", "Kigali", "Father {n}", "Mother {n}", "5000", "30"]
+REGISTRATION_STEPS = ["national_id", "full_name", "address", "father_name", "mother_name", "loan_amount", "duration"]
+
+def register_steps_session(n):
+    texts = ["", "1"]
+    answers = [a.format(n=n, nid=f"B{n:09d}") for a in REGISTRATION_ANSWERS]
+    for i in range(len(answers)):
+        texts.append("*".join(["1"] + answers[:i + 1]))
+    labels = ["menu", "register"] + [f"register:{s}" for s in REGISTRATION_STEPS]
+    return list(zip(labels, texts))
+
+def register_single_session(n):
+    text = f"1*B{n:09d}*Bench User {n}*Kigali*Father {n}*Mother {n}*5000*30"
+    return [("menu", ""), ("register:single", text)]
+
+def balance_session(n):
+    return [("menu", ""), ("balance", "2")]
+
+def history_session(n):
+    return [("menu", ""), ("history", "3")]
+
+SESSION_TYPES = {
+    "register_steps": (register_steps_session, True),
+    "register_single": (register_single_session, True),
+    "balance": (balance_session, False),
+    "history": (history_session, False),
+}
+DEFAULT_MIX = "register_steps=1,register_single=1,balance=4,history=4"
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SESSION_TYPES:
+            raise SystemExit(f"Unknown session type {name!r}; choose from {', '.join(SESSION_TYPES)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+# -------------------
+# SYNTHETIC DATABASE
+# -------------------
+# Seeded borrowers come from synthetic_portfolio.py; registrations use a
+# separate phone range so they never collide with them.
+seeded_phone = borrower_phone
+
+def new_phone(i):
+    return f"+2509{i:08d}"
+
+def seed_database(users, seed=0):
+    """Give an empty database `users` synthetic borrowers."""
+    generate_portfolio(users, seed)
+
+# -------------------
+# DRIVERS
+# -------------------
+class TestClientDriver:
+    """Posts through the Flask test client, one client per thread."""
+
+    def __init__(self):
+        from app import app
+        self.app = app
+        self._local = threading.local()
+
+    def post(self, data):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post("/ussd", data=data)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpDriver:
+    """Posts form data to a running server."""
+
+    def __init__(self, url):
+        self.url = url
+
+    def post(self, data):
+        body = urllib.parse.urlencode(data).encode()
+        try:
+            with urllib.request.urlopen(self.url, data=body, timeout=30) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode(errors="replace")
+        except OSError as e:  # refused, reset or timed out: counted as an error
+            return 0, str(e)
+
+# -------------------
+# RUNNER
+# -------------------
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile.
+    k = math.ceil(p / 100 * len(sorted_values)) - 1
+    return sorted_values[max(0, min(k, len(sorted_values) - 1))]
+
+def run_benchmark(driver, sessions, concurrency, mix, seeded_users, seed=0):
+    rng = random.Random(seed)
+    names = list(mix)
+    plan = rng.choices(names, weights=[mix[n] for n in names], k=sessions)
+    phones = [new_phone(i) if SESSION_TYPES[name][1] or not seeded_users else seeded_phone(rng.randrange(seeded_users))
+              for i, name in enumerate(plan)]
+    run_id = f"{os.getpid()}-{int(time.time())}"
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def _session(i):
+        build = SESSION_TYPES[plan[i]][0]
+        phone = phones[i]
+        session_id = f"bench-{run_id}-{i}"
+        timings = []
+        for label, text in build(i):
+            started = time.perf_counter()
+            status, body = driver.post({"sessionId": session_id, "phoneNumber": phone, "text": text})
+            elapsed = time.perf_counter() - started
+            timings.append((label, elapsed, status != 200 or not body.startswith(("CON", "END"))))
+        with lock:
+            for label, elapsed, failed in timings:
+                latencies[label].append(elapsed)
+                if failed:
+                    errors[label] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(_session, range(sessions)))
+    wall = time.perf_counter() - started
+
+    steps = {}
+    for label, values in sorted(latencies.items()):
+        values.sort()
+        steps[label] = {
+            "requests": len(values),
+            "errors": errors[label],
+            "throughput_rps": round(len(values) / wall, 1),
+            "mean_ms": round(sum(values) / len(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+        }
+    total = sum(s["requests"] for s in steps.values())
+    return {
+        "sessions": sessions,
+        "requests": total,
+        "errors": sum(errors.values()),
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(total / wall, 1),
+        "sessions_per_second": round(sessions / wall, 1),
+        "steps": steps,
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(result, baseline=None):
+    print(f"\n{result['sessions']} sessions, {result['requests']} requests in {result['wall_seconds']}s "
+          f"({result['throughput_rps']} req/s, {result['sessions_per_second']} sessions/s, {result['errors']} errors)")
+    print(f"{'step':<22}{'reqs':>7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for label, s in result["steps"].items():
+        line = (f"{label:<22}{s['requests']:>7}{s['throughput_rps']:>9}{s['p50_ms']:>9}"
+                f"{s['p95_ms']:>9}{s['p99_ms']:>9}{s['errors']:>8}")
+        old = (baseline or {}).get("steps", {}).get(label)
+        if old and old["p95_ms"]:
+            line += f"   p95 {(s['p95_ms'] - old['p95_ms']) / old['p95_ms']:+.0%} vs {baseline.get('revision') or 'baseline'}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the /ussd route")
+    parser.add_argument('--url', help='POST to a running server instead of the Flask test client')
+    parser.add_argument('--db', help='Database to seed and use (default: a fresh temporary file)')
+    parser.add_argument('--users', type=int, default=10000, help='Borrowers in the synthetic database')
+    parser.add_argument('--sessions', type=int, default=2000, help='USSD sessions to replay')
+    parser.add_argument('--concurrency', type=int, default=16, help='Sessions in flight at once')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Session weights, e.g. ' + DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the session mix')
+    parser.add_argument('--output', help='Write the JSON results here')
+    parser.add_argument('--compare', help='Earlier JSON results to compare against')
+    args = parser.parse_args()
+
+    # db_pool reads USSD_DB_PATH at import time, so set it before importing app.
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="ussd_bench_"), "bench.db")
+    os.environ["USSD_DB_PATH"] = os.path.abspath(db_path)
+    from migrations import migrate
+    migrate()
+    seed_database(args.users)
+
+    driver = HttpDriver(args.url) if args.url else TestClientDriver()
+    result = run_benchmark(driver, args.sessions, args.concurrency, parse_mix(args.mix), args.users, args.seed)
+    result.update({
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "driver": "http" if args.url else "test_client",
+        "url": args.url,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "mix": args.mix,
+        "session_store": os.environ.get("USSD_SESSION_STORE", "memory"),
+    })
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"✅ Results saved to {args.output}")
@@ -0,0 +1,286 @@
+import argparse
+import csv
+import json
+import math
+import os
+import time
+from datetime import datetime
+from database import get_job_state, set_job_state
+from db_pool import DB_NAME, get_conn, run_write
+from deduction import WATERMARK
+from migrations import migrate, next_change_seq, set_bulk_load
+
+# -------------------
+# BULK BORROWER IMPORT
+# -------------------
+# Streams borrowers from a CSV (with a header row) or JSONL file, validates
+# them and inserts users and their daily repayment schedules in large
+# batches, one transaction each. The number of input records consumed (and
+# the size of the rejects file at that point) is committed with every
+# batch, so an interrupted import resumes right after the last committed
+# batch.
+#
+# A record may give paid_installments, the number of its first
+# installments already paid before the import; without it none are. Unpaid
+# installments already due count as arrears in the portfolio figures, but
+# the deduction job only charges them when the import runs with
+# --collect_overdue, which moves the deduction watermark back to them.
+#
+# Imported users rows carry a change_seq, so web workers drop any cached
+# "not registered" reply for their phones on the next USSD lookup
+# (ussd_cache.PhoneCache.sync).
+IMPORT_BATCH_ROWS = 20000
+# Page cache for the importing connection; the repayments indexes grow by
+# tens of MB per batch.
+IMPORT_CACHE_KIB = 256 * 1024
+
+FIELDS = ("session_id", "phone", "national_id", "full_name", "address", "father_name", "mother_name",
+          "loan_amount", "duration", "date_registered")
+# Validated rows are FIELDS followed by paid_installments.
+PAID_INDEX = len(FIELDS)
+
+# updated_at and change_seq are parameters, so the change tracking
+# triggers (migrations 8 and 10) have nothing to do. Each batch takes one
+# change_seq (see _write_batch).
+USERS_INSERT_SQL = f"""
+    INSERT INTO users ({', '.join(FIELDS)}, updated_at, change_seq)
+    VALUES ({', '.join('?' for _ in FIELDS)}, ?, ?)
+"""
+# Staging table: one row per imported user, with what its schedule needs
+# worked out once rather than per installment.
+BATCH_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS import_batch (
+        user_id INTEGER PRIMARY KEY, paid_installments INTEGER, installment REAL, duration INTEGER,
+        registered_ts INTEGER
+    )
+"""
+BATCH_INSERT_SQL = """
+    INSERT INTO temp.import_batch
+    SELECT id, ?, round(loan_amount / duration, 2), duration, CAST(strftime('%s', date_registered, 'utc') AS INTEGER)
+    FROM users WHERE id = ?
+"""
+# Installments start the day after registration, like SCHEDULE_INSERT_SQL
+# in app.py. Installment n is paid when n <= paid_installments. CROSS JOIN
+# keeps the batch as the outer loop.
+SCHEDULE_INSERT_SQL = """
+    WITH RECURSIVE days(n) AS (
+        SELECT 1 UNION ALL SELECT n + 1 FROM days WHERE n < :max_duration
+    )
+    INSERT INTO repayments (user_id, amount, due_ts, paid, updated_at, change_seq)
+    SELECT batch.user_id, batch.installment, batch.registered_ts + days.n * 86400,
+           days.n <= batch.paid_installments, :now, :seq
+    FROM temp.import_batch batch CROSS JOIN days ON days.n <= batch.duration
+"""
+
+# -------------------
+# READING AND VALIDATION
+# -------------------
+def read_records(path, fmt=None):
+    """Yield one dict per borrower from a CSV or JSONL file."""
+    fmt = fmt or ("jsonl" if path.endswith((".jsonl", ".json")) else "csv")
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield line.rstrip("\n")
+
+def _whole_number(value):
+    """int(value) for "30", 30 or "30.0" (as spreadsheets write it); raises ValueError otherwise."""
+    number = float(str(value).strip())
+    if not number.is_integer():
+        raise ValueError(f"{value!r} is not a whole number")
+    return int(number)
+
+def validate(record, seen_phones, now):
+    """Return (row, None) for a valid record, or (None, reason)."""
+    if not isinstance(record, dict):
+        return None, "not a JSON object"
+    phone = str(record.get("phone") or "").strip()
+    if not phone:
+        return None, "missing phone"
+    if phone in seen_phones:
+        return None, "duplicate phone"
+    try:
+        loan_amount = float(record.get("loan_amount"))
+    except (TypeError, ValueError):
+        return None, "loan_amount is not a number"
+    if not math.isfinite(loan_amount) or loan_amount <= 0:
+        return None, "loan_amount must be positive"
+    try:
+        duration = _whole_number(record.get("duration"))
+    except ValueError:
+        return None, "duration is not a whole number of days"
+    if duration <= 0:
+        return None, "duration must be positive"
+    paid = record.get("paid_installments")
+    if paid is not None and str(paid).strip() != "":
+        try:
+            paid = _whole_number(paid)
+        except ValueError:
+            return None, "paid_installments is not a whole number"
+        if not 0 <= paid <= duration:
+            return None, "paid_installments must be between 0 and duration"
+    else:
+        paid = 0
+    registered = record.get("date_registered")
+    if registered:
+        try:
+            registered = datetime.fromisoformat(str(registered).strip()).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None, "date_registered is not a date"
+    else:
+        registered = now
+    seen_phones.add(phone)
+    return (record.get("session_id") or "import", phone, record.get("national_id"), record.get("full_name"),
+            record.get("address"), record.get("father_name"), record.get("mother_name"),
+            loan_amount, duration, registered, paid), None
+
+# -------------------
+# WRITING
+# -------------------
+def _write_batch(conn, rows, checkpoint_key, checkpoint, collect_overdue=False):
+    conn.execute(f"PRAGMA cache_size=-{IMPORT_CACHE_KIB}")
+    # The per-row insert triggers skip this transaction's rows; the
+    # statements below maintain the same tables once per batch.
+    set_bulk_load(conn, True)
+
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]
+    seq = next_change_seq(conn)
+    now_ts = int(time.time())
+    conn.executemany(USERS_INSERT_SQL, [row[:PAID_INDEX] + (now_ts, seq) for row in rows])
+    # Ids are handed out in insert order.
+    ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE id > ? ORDER BY id", (last_id,))]
+    conn.execute(BATCH_TABLE_SQL)
+    conn.execute("DELETE FROM temp.import_batch")
+    conn.executemany(BATCH_INSERT_SQL, zip((row[PAID_INDEX] for row in rows), ids))
+    conn.execute(SCHEDULE_INSERT_SQL, {"max_duration": max(row[8] for row in rows), "now": now_ts, "seq": seq})
+
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='users_fts'").fetchone():
+        conn.execute("""
+            INSERT INTO users_fts (rowid, full_name, phone, national_id)
+            SELECT id, full_name, phone, national_id FROM users WHERE id > ?
+        """, (last_id,))
+    conn.execute("""
+        INSERT INTO loan_progress (user_id, unpaid_count)
+        SELECT user_id, SUM(paid != 1) FROM repayments WHERE user_id > ? GROUP BY user_id
+    """, (last_id,))
+    conn.execute("""
+        UPDATE portfolio_summary SET
+            total_users = total_users + (SELECT COUNT(*) FROM users WHERE id > ?1),
+            total_loans = total_loans + (SELECT COALESCE(SUM(loan_amount), 0) FROM users WHERE id > ?1),
+            outstanding_balance = outstanding_balance
+                + (SELECT COALESCE(SUM(amount), 0) FROM repayments WHERE user_id > ?1 AND paid != 1),
+            completed_users = completed_users
+                + (SELECT COUNT(*) FROM loan_progress WHERE user_id > ?1 AND unpaid_count = 0)
+    """, (last_id,))
+
+    if collect_overdue:
+        # Unpaid installments already due would otherwise sit behind the
+        # deduction watermark and never be collected.
+        first_due = conn.execute("SELECT MIN(due_ts) FROM repayments WHERE user_id > ? AND paid != 1",
+                                 (last_id,)).fetchone()[0]
+        watermark = get_job_state(WATERMARK, conn=conn)
+        if watermark and first_due is not None and first_due <= int(watermark):
+            set_job_state(WATERMARK, first_due - 1, conn=conn)
+
+    set_job_state(checkpoint_key, json.dumps(checkpoint), conn=conn)
+    set_bulk_load(conn, False)
+
+def _load_checkpoint(checkpoint_key, db_name=DB_NAME):
+    """Return (records done, rejects file size) saved for checkpoint_key."""
+    saved = get_job_state(checkpoint_key, conn=get_conn(db_name))
+    if not saved:
+        return 0, 0
+    saved = json.loads(saved)
+    if isinstance(saved, int):
+        # Saved before the rejects size was recorded.
+        return saved, None
+    return saved["records"], saved["rejects_bytes"]
+
+def import_borrowers(path, fmt=None, batch_size=IMPORT_BATCH_ROWS, rejects_path=None, restart=False,
+                     collect_overdue=False, db_name=DB_NAME):
+    """Import borrowers from path and return (imported, rejected) for this run.
+
+    Installments beyond a record's paid_installments (default 0) are
+    imported unpaid. collect_overdue moves the deduction watermark back so
+    the next run charges the ones already due; otherwise it never does.
+    """
+    migrate(db_name)
+    checkpoint_key = f"bulk_import:{os.path.abspath(path)}"
+    if restart:
+        run_write(lambda conn: conn.execute("DELETE FROM job_state WHERE name=?", (checkpoint_key,)), db_name)
+    done, rejects_bytes = _load_checkpoint(checkpoint_key, db_name)
+    if done:
+        print(f"⚠️ Resuming {path} after {done} records already imported or rejected.")
+    rejects_path = rejects_path or path + ".rejects.jsonl"
+    # Rejects written after the last committed batch are written again.
+    if rejects_bytes is not None and os.path.exists(rejects_path):
+        with open(rejects_path, "r+b") as f:
+            f.truncate(rejects_bytes)
+    seen_phones = {row[0] for row in get_conn(db_name).execute("SELECT phone FROM users")}
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rejects = None
+    imported = rejected = 0
+    batch = []
+    started = time.perf_counter()
+    committed = done
+
+    def _flush(records_done):
+        nonlocal imported, committed
+        if rejects is not None:
+            rejects.flush()
+        checkpoint = {"records": records_done,
+                      "rejects_bytes": rejects.tell() if rejects is not None else rejects_bytes or 0}
+        if batch:
+            run_write(lambda conn: _write_batch(conn, batch, checkpoint_key, checkpoint, collect_overdue), db_name)
+            imported += len(batch)
+        else:
+            run_write(lambda conn: set_job_state(checkpoint_key, json.dumps(checkpoint), conn=conn), db_name)
+        batch.clear()
+        committed = records_done
+        rate = imported / max(time.perf_counter() - started, 1e-9)
+        print(f"✅ {records_done} records processed: {imported} imported, {rejected} rejected ({rate:.0f} borrowers/s)")
+
+    number = 0
+    try:
+        for number, record in enumerate(read_records(path, fmt), start=1):
+            if number <= done:
+                continue
+            row, reason = validate(record, seen_phones, now)
+            if row is None:
+                rejected += 1
+                if rejects is None:
+                    rejects = open(rejects_path, "a", encoding="utf-8")
+                rejects.write(json.dumps({"record": number, "reason": reason, "data": record}) + "\n")
+            else:
+                batch.append(row)
+            if len(batch) >= batch_size:
+                _flush(number)
+        if number > committed:
+            _flush(number)
+    finally:
+        if rejects is not None:
+            rejects.close()
+    if rejected:
+        print(f"⚠️ {rejected} records rejected, see {rejects_path}")
+    return imported, rejected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import borrowers and their repayment schedules")
+    parser.add_argument('path', help='CSV (with header) or JSONL file of borrowers; an optional paid_installments '
+                                     'field counts the installments already paid (default 0: all unpaid)')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help='Input format (default: from the file extension)')
+    parser.add_argument('--batch_size', type=int, default=IMPORT_BATCH_ROWS, help='Borrowers per transaction')
+    parser.add_argument('--rejects', help='Where to write rejected records (default: <path>.rejects.jsonl)')
+    parser.add_argument('--restart', action='store_true', help='Ignore the saved progress and start from the first record')
+    parser.add_argument('--collect_overdue', action='store_true',
+                        help='Have the deduction job charge unpaid installments already due. Without it they '
+                             'stay unpaid (arrears in the portfolio figures) but are never deducted')
+    args = parser.parse_args()
+    import_borrowers(args.path, args.format, args.batch_size, args.rejects, args.restart, args.collect_overdue)
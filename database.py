@@ -1,161 +1,148 @@
-import os
-import sqlite3
-from datetime import datetime, timedelta
-
-DB_NAME = os.path.join(os.path.dirname(__file__), "users.db")
+import time
+from datetime import datetime
+from db_pool import DB_NAME, get_conn, run_write
+from migrations import migrate, next_change_seq, rebuild_portfolio_summary
+import user_search
+from ussd_cache import invalidate_phones, invalidate_users
+from utils import calculate_float
 
 # ----------------------
 # DATABASE INITIALIZATION
 # ----------------------
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-
-    # Users table
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        session_id TEXT,
-        phone TEXT UNIQUE,
-        national_id TEXT,
-        full_name TEXT,
-        address TEXT,
-        father_name TEXT,
-        mother_name TEXT,
-        loan_amount REAL,
-        duration INTEGER,
-        date_registered TEXT
-    )
-    """)
-
-    # Repayments table
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS repayments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount REAL,
-        due_date TEXT,
-        paid INTEGER DEFAULT 0
-    )
-    """)
-
-    conn.commit()
-    conn.close()
+    # Creates or upgrades the schema; see migrations.py.
+    migrate(DB_NAME)
 
 # ----------------------
 # USER FUNCTIONS
 # ----------------------
 def add_user(session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
     date_registered = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("""
-        INSERT INTO users (session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration, date_registered)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration, date_registered))
-    user_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    def _insert(conn):
+        return conn.execute("""
+            INSERT INTO users (session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration, date_registered)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (session_id, phone, national_id, full_name, address, father_name, mother_name, loan_amount, duration, date_registered)).lastrowid
+    user_id = run_write(_insert, DB_NAME)
+    invalidate_phones(phone)
     return user_id
 
 def search_users(search=""):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    if search:
-        c.execute("SELECT * FROM users WHERE full_name LIKE ? OR phone LIKE ?", (f"%{search}%", f"%{search}%"))
-    else:
-        c.execute("SELECT * FROM users")
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return user_search.search_users(search, DB_NAME)
 
 def get_user_by_id(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    row = get_conn(DB_NAME).execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
     return dict(row) if row else None
 
 def get_user_by_phone(phone):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE phone=?", (phone,))
-    row = c.fetchone()
-    conn.close()
+    row = get_conn(DB_NAME).execute("SELECT * FROM users WHERE phone=?", (phone,)).fetchone()
     return dict(row) if row else None
 
 def delete_user(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM users WHERE id=?", (user_id,))
-    c.execute("DELETE FROM repayments WHERE user_id=?", (user_id,))
-    conn.commit()
-    conn.close()
+    def _delete(conn):
+        conn.execute("DELETE FROM users WHERE id=?", (user_id,))
+        conn.execute("DELETE FROM repayments WHERE user_id=?", (user_id,))
+    run_write(_delete, DB_NAME)
+    invalidate_users(user_id)
 
 # ----------------------
 # REPAYMENT FUNCTIONS
 # ----------------------
+# One installment per day, starting tomorrow, generated in a single statement.
+# Due dates are Unix timestamps (repayments.due_ts).
+SCHEDULE_INSERT_SQL = """
+    WITH RECURSIVE days(n) AS (
+        SELECT 1 UNION ALL SELECT n + 1 FROM days WHERE n < ?
+    )
+    INSERT INTO repayments (user_id, amount, due_ts, updated_at, change_seq)
+    SELECT ?, ?, ? + n * 86400, ?, ?
+    FROM days WHERE n <= ?
+"""
+
 def generate_repayment_schedule(user_id, loan_amount, duration):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
     installment_amount = round(loan_amount / duration, 2)
-    today = datetime.now()
-    for i in range(duration):
-        due_date = (today + timedelta(days=i+1)).strftime("%Y-%m-%d %H:%M:%S")
-        c.execute("INSERT INTO repayments (user_id, amount, due_date) VALUES (?, ?, ?)", (user_id, installment_amount, due_date))
-    conn.commit()
-    conn.close()
+    now = int(time.time())
+    run_write(lambda conn: conn.execute(SCHEDULE_INSERT_SQL, (duration, user_id, installment_amount, now, now,
+                                                              next_change_seq(conn), duration)), DB_NAME)
+    invalidate_users(user_id)
 
 def get_repayments_by_user(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT id, user_id, amount, due_date, paid FROM repayments WHERE user_id=?", (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    rows = get_conn(DB_NAME).execute("SELECT id, user_id, amount, due_ts, paid FROM repayments WHERE user_id=? ORDER BY due_ts", (user_id,)).fetchall()
     return [dict(r) for r in rows]
 
 def mark_repayment_as_paid(repayment_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE repayments SET paid=1 WHERE id=?", (repayment_id,))
-    conn.commit()
-    conn.close()
+    def _mark(conn):
+        conn.execute("UPDATE repayments SET paid=1 WHERE id=?", (repayment_id,))
+        row = conn.execute("SELECT user_id FROM repayments WHERE id=?", (repayment_id,)).fetchone()
+        return row["user_id"] if row else None
+    user_id = run_write(_mark, DB_NAME)
+    if user_id is not None:
+        invalidate_users(user_id)
+
+# ----------------------
+# MOMOPAY FUNCTIONS
+# ----------------------
+def add_momopay(phone, balance, float_shared=0):
+    run_write(lambda conn: conn.execute("""
+        INSERT INTO momopays (phone, balance, float_shared) VALUES (?, ?, ?)
+        ON CONFLICT(phone) DO UPDATE SET balance=excluded.balance, float_shared=excluded.float_shared
+    """, (phone, balance, float_shared)), DB_NAME)
+
+def get_momopays():
+    rows = get_conn(DB_NAME).execute("SELECT * FROM momopays").fetchall()
+    return [dict(r) for r in rows]
+
+def update_momopay_balance(phone, amount):
+    """Deduct amount from the MoMoPay account registered to phone."""
+    run_write(lambda conn: conn.execute("UPDATE momopays SET balance = balance - ? WHERE phone=?", (amount, phone)), DB_NAME)
+
+def share_float(repayment_id):
+    """Credit the borrower's MoMoPay float with its share of a repayment."""
+    def _share(conn):
+        row = conn.execute("""
+            SELECT r.amount, u.phone FROM repayments r JOIN users u ON u.id = r.user_id WHERE r.id=?
+        """, (repayment_id,)).fetchone()
+        if row:
+            conn.execute("UPDATE momopays SET float_shared = float_shared + ? WHERE phone=?",
+                         (calculate_float(row["amount"]), row["phone"]))
+    run_write(_share, DB_NAME)
+
+# ----------------------
+# JOB STATE
+# ----------------------
+# Pass conn to read or write inside a caller's open transaction.
+def get_job_state(name, default=None, conn=None):
+    row = (conn or get_conn(DB_NAME)).execute("SELECT value FROM job_state WHERE name=?", (name,)).fetchone()
+    return row[0] if row else default
+
+def set_job_state(name, value, conn=None):
+    sql = "INSERT INTO job_state (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value=excluded.value"
+    if conn is not None:
+        conn.execute(sql, (name, value))
+    else:
+        run_write(lambda conn: conn.execute(sql, (name, value)), DB_NAME)
 
 # ----------------------
 # DASHBOARD SUMMARY
 # ----------------------
-def get_dashboard_summary():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users = c.fetchone()[0]
-
-    c.execute("SELECT SUM(loan_amount) FROM users")
-    total_loans = c.fetchone()[0] or 0
-
-    c.execute("""
-        SELECT COUNT(*) FROM users u
-        WHERE NOT EXISTS (
-            SELECT 1 FROM repayments r
-            WHERE r.user_id = u.id AND r.paid != 1
-        )
-    """)
-    completed_users = c.fetchone()[0]
-    in_progress = total_users - completed_users
-
-    conn.close()
+def get_dashboard_summary(db_name=DB_NAME):
+    # Single-row read: the counters are maintained by triggers (migration 5).
+    row = get_conn(db_name).execute("""
+        SELECT total_users, total_loans, completed_users, outstanding_balance
+        FROM portfolio_summary WHERE id = 1
+    """).fetchone()
     return {
-        "total_users": total_users,
-        "total_loans": total_loans,
-        "completed_users": completed_users,
-        "in_progress": in_progress
+        "total_users": row["total_users"],
+        "total_loans": round(row["total_loans"], 2),
+        "completed_users": row["completed_users"],
+        "in_progress": row["total_users"] - row["completed_users"],
+        "outstanding_balance": round(row["outstanding_balance"], 2)
     }
 
+def reconcile_portfolio_summary():
+    """Rebuild the dashboard counters from scratch and return them."""
+    run_write(rebuild_portfolio_summary, DB_NAME)
+    return get_dashboard_summary()
+
 # Initialize DB when module is imported
 init_db()
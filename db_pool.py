@@ -0,0 +1,235 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import METRICS_ENABLED, attribute_sql, record_sql, sql_snapshot
+
+# ----------------------
+# DATABASE LOCATION
+# ----------------------
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_NAME = os.environ.get("USSD_DB_PATH") or os.path.join(BASE_DIR, "users.db")
+
+# Prepared statements kept per connection. The helpers only use a few dozen
+# distinct SQL strings, so every hot query stays compiled for the life of
+# the connection.
+STATEMENT_CACHE_SIZE = 256
+
+# How long a connection waits on another process's lock before raising
+# "database is locked".
+BUSY_TIMEOUT_MS = int(os.environ.get("USSD_DB_BUSY_TIMEOUT_MS", "10000"))
+
+# Opt-in WAL storage mode (USSD_DB_WAL=1). Readers then never wait for
+# writers, and all writes of a process go through a single writer thread
+# that commits small writes in groups.
+WAL_MODE = os.environ.get("USSD_DB_WAL", "").lower() in ("1", "true", "yes", "on")
+WAL_AUTOCHECKPOINT_PAGES = int(os.environ.get("USSD_DB_WAL_AUTOCHECKPOINT", "1000"))
+WAL_SIZE_LIMIT_BYTES = 64 * 1024 * 1024
+# Most writes a writer thread groups into one commit.
+WRITE_BATCH_SIZE = 64
+
+# Pragmas applied once, when a connection is opened.
+CONNECTION_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+)
+WAL_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # In WAL mode NORMAL only syncs at checkpoints: a power cut can lose the
+    # last commits but never corrupts the database.
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA wal_autocheckpoint={WAL_AUTOCHECKPOINT_PAGES}",
+    f"PRAGMA journal_size_limit={WAL_SIZE_LIMIT_BYTES}",
+)
+
+# ----------------------
+# PER-THREAD CONNECTIONS
+# ----------------------
+_local = threading.local()
+# Connections inherited through fork() are parked here instead of being
+# closed: they belong to the parent process and must not be touched.
+_inherited = []
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Counts statements and the time spent in them for metrics.py.
+
+    Only the execute call is timed: rows fetched afterwards from a large
+    result are not included.
+    """
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(time.perf_counter() - started)
+
+
+def _connect(db_name):
+    # "file:" names are SQLite URIs: the read-only snapshots of snapshot.py.
+    uri = db_name.startswith("file:")
+    conn = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=STATEMENT_CACHE_SIZE,
+                           factory=_TimedConnection if METRICS_ENABLED else sqlite3.Connection, uri=uri)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    if WAL_MODE and not uri:
+        for pragma in WAL_PRAGMAS:
+            conn.execute(pragma)
+    return conn
+
+
+def _thread_conns():
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        # First use in this thread, or first use after a gunicorn fork.
+        old = getattr(_local, "conns", None)
+        if old:
+            _inherited.extend(old.values())
+        _local.conns = {}
+        _local.pid = pid
+    return _local.conns
+
+
+def get_conn(db_name=DB_NAME):
+    """Return this thread's long-lived connection to db_name."""
+    conns = _thread_conns()
+    conn = conns.get(db_name)
+    if conn is None:
+        conn = conns[db_name] = _connect(db_name)
+    return conn
+
+
+def close_conn(db_name=DB_NAME):
+    """Close this thread's connection to db_name, if one is open."""
+    conn = _thread_conns().pop(db_name, None)
+    if conn is not None:
+        conn.close()
+
+
+# ----------------------
+# WRITES
+# ----------------------
+def _write_in_transaction(conn, fn):
+    if conn.in_transaction:
+        # Nested write: join the caller's transaction.
+        return fn(conn)
+    # BEGIN IMMEDIATE takes the write lock up front, so a transaction that
+    # reads before it writes cannot deadlock against another writer.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(conn)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return result
+
+
+class _Writer:
+    """Single writer thread for one database in one process.
+
+    Callers queue a function and wait for its result. The thread drains up
+    to WRITE_BATCH_SIZE queued writes, runs each in its own savepoint and
+    commits them together, so a burst of small writes costs one fsync.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn):
+        future = Future()
+        self.queue.put((fn, future))
+        return future
+
+    def _run(self):
+        conn = get_conn(self.db_name)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(conn, batch)
+
+    def _commit_batch(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                conn.execute("SAVEPOINT batch_item")
+                try:
+                    results.append((future, fn(conn), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO batch_item")
+                    results.append((future, None, e))
+                conn.execute("RELEASE batch_item")
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def _get_writer(db_name):
+    with _writers_lock:
+        writer = _writers.get(db_name)
+        if writer is None or writer.pid != os.getpid():
+            # Threads do not survive fork(), so each worker starts its own.
+            writer = _writers[db_name] = _Writer(db_name)
+        return writer
+
+
+def _measured(fn, conn):
+    # Runs on the writer thread; the caller is charged for the SQL it issued.
+    count, seconds = sql_snapshot()
+    result = fn(conn)
+    after_count, after_seconds = sql_snapshot()
+    return result, after_count - count, after_seconds - seconds
+
+
+def run_write(fn, db_name=DB_NAME):
+    """Run fn(conn) in a write transaction and return its result.
+
+    fn must not commit or roll back itself. In WAL mode the call is queued
+    to this process's writer thread; otherwise it runs on the caller's
+    pooled connection.
+    """
+    if WAL_MODE:
+        if threading.current_thread() is getattr(_writers.get(db_name), "thread", None):
+            # Already inside a queued write: run in the open transaction.
+            return fn(get_conn(db_name))
+        if not METRICS_ENABLED:
+            return _get_writer(db_name).submit(fn).result()
+        result, statements, seconds = _get_writer(db_name).submit(lambda conn: _measured(fn, conn)).result()
+        attribute_sql(statements, seconds)
+        return result
+    return _write_in_transaction(get_conn(db_name), fn)
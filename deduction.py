@@ -0,0 +1,166 @@
+import os
+from collections import defaultdict
+from datetime import datetime
+from database import get_job_state, set_job_state
+from db_pool import DB_NAME, run_write
+from migrations import next_change_seq
+from ussd_cache import invalidate_phones
+from utils import calculate_float
+
+try:
+    import numpy as np
+except ImportError:  # only the "loop" allocation runs without NumPy
+    np = None
+
+# -------------------
+# AUTO DEDUCTION ENGINE
+# -------------------
+# One run reads only the unpaid repayments that fell due since the previous
+# run (an index range scan on repayments(paid, due_ts) between the stored
+# watermark and now), settles them against the MoMoPay balances in memory
+# and writes every balance, paid flag and float share back, together with
+# the new watermark, in a single transaction. Its cost follows the number
+# of newly due items, not the size of the portfolio or its history. After
+# a restart the first run simply covers every window that was missed.
+DUE_REPAYMENTS_SQL = """
+    SELECT r.id, r.amount, u.phone
+    FROM repayments r
+    JOIN users u ON u.id = r.user_id
+    WHERE r.paid = 0 AND r.due_ts > ? AND r.due_ts <= ?
+    ORDER BY r.due_ts, r.id
+"""
+# job_state key holding the due_ts up to which repayments are settled.
+WATERMARK = "auto_deduction_watermark"
+
+def _settle(due, balances):
+    """Apply the due repayments to balances (phone -> balance) in place.
+
+    Each installment comes from the borrower's own account when it covers
+    the amount, otherwise proportionally from every account's balance.
+    Returns (own_account_count, pooled_count).
+    """
+    merged_balance = sum(balances.values())
+    own = pooled = 0
+    for r in due:
+        amount = r["amount"]
+        balance = balances.get(r["phone"])
+        if balance is not None and balance >= amount:
+            balances[r["phone"]] = balance - amount
+            merged_balance -= amount
+            own += 1
+        else:
+            if merged_balance > 0:
+                proportion = amount / merged_balance
+                for phone in balances:
+                    balances[phone] -= balances[phone] * proportion
+                merged_balance -= amount
+            pooled += 1
+    return own, pooled
+
+# Below this scale factor the vectorized allocation folds the factor back
+# into the balance vector to keep the arithmetic well conditioned.
+MIN_SCALE = 1e-6
+
+def _settle_vectorized(due, balances):
+    """Batch allocation: same result as _settle, one NumPy pass overall.
+
+    A proportional deduction multiplies every balance by the same factor
+    (1 - amount / merged_balance), so balances are kept as vector * scale:
+    pooled repayments only update the scalar scale, own-account repayments
+    touch one element, and the vector is multiplied out once at the end.
+    """
+    phones = list(balances)
+    index = {phone: i for i, phone in enumerate(phones)}
+    vector = np.array([balances[phone] for phone in phones], dtype=float)
+    scale = 1.0
+    merged_balance = float(vector.sum())
+    own = pooled = 0
+    for r in due:
+        amount = r["amount"]
+        i = index.get(r["phone"])
+        if i is not None and vector[i] * scale >= amount:
+            vector[i] -= amount / scale
+            merged_balance -= amount
+            own += 1
+        else:
+            if merged_balance > 0:
+                scale *= 1 - amount / merged_balance
+                merged_balance -= amount
+                if abs(scale) < MIN_SCALE:
+                    vector *= scale
+                    scale = 1.0
+            pooled += 1
+    vector *= scale
+    for phone, balance in zip(phones, vector.tolist()):
+        balances[phone] = balance
+    return own, pooled
+
+# USSD_DEDUCTION_ALLOCATION picks how pooled deductions are computed:
+#   vector - _settle_vectorized (default; needs numpy, see requirements.txt)
+#   loop   - _settle, pure Python
+ALLOCATIONS = {"vector": _settle_vectorized, "loop": _settle}
+DEFAULT_ALLOCATION = os.environ.get("USSD_DEDUCTION_ALLOCATION", "vector").lower()
+
+def check_allocation(allocation=DEFAULT_ALLOCATION):
+    """Raise unless `allocation` can run here; the scheduler calls this at start-up."""
+    if allocation not in ALLOCATIONS:
+        raise ValueError(f"Unknown deduction allocation {allocation!r}; choose from {', '.join(ALLOCATIONS)}")
+    if allocation == "vector" and np is None:
+        raise RuntimeError("The vector deduction allocation needs numpy: install requirements.txt "
+                           "or set USSD_DEDUCTION_ALLOCATION=loop")
+
+def run_auto_deduction(now=None, db_name=DB_NAME, allocation=DEFAULT_ALLOCATION):
+    """Settle every unpaid repayment due at `now` and return a run summary.
+
+    The summary counts due, own-account and pooled repayments, and maps
+    each MoMoPay phone to the total deducted from it in this run.
+    """
+    now = int((now or datetime.now()).timestamp())
+    check_allocation(allocation)
+    settle = ALLOCATIONS[allocation]
+
+    def _run(conn):
+        watermark = get_job_state(WATERMARK, conn=conn)
+        # No watermark yet: everything due so far (nothing is due before 1970).
+        due = conn.execute(DUE_REPAYMENTS_SQL, (int(watermark) if watermark else 0, now)).fetchall()
+        set_job_state(WATERMARK, now, conn=conn)
+        since = datetime.fromtimestamp(int(watermark)).strftime("%Y-%m-%d %H:%M:%S") if watermark else ""
+        if not due:
+            return {"due": 0, "own_account": 0, "pooled": 0, "deducted": {}, "since": since}, ()
+        balances = {row["phone"]: row["balance"] or 0 for row in conn.execute("SELECT phone, balance FROM momopays")}
+        before = dict(balances)
+        own, pooled = settle(due, balances)
+
+        float_shares = defaultdict(float)
+        for r in due:
+            float_shares[r["phone"]] += calculate_float(r["amount"])
+
+        # updated_at and change_seq are set here rather than by the change
+        # tracking triggers (migrations 8 and 10), which would cost a second
+        # write per row. Each row is written once: a second UPDATE leaving
+        # change_seq as it is would fire the touch trigger.
+        seq = next_change_seq(conn)
+        touched = {phone for phone, balance in balances.items() if balance != before[phone]}
+        touched.update(phone for phone in float_shares if phone in balances)
+        conn.executemany("""
+            UPDATE momopays SET balance=?, float_shared = float_shared + ?, updated_at=?, change_seq=? WHERE phone=?
+        """, [(balances[phone], float_shares.get(phone, 0.0), now, seq, phone) for phone in touched])
+        conn.executemany("UPDATE repayments SET paid=1, updated_at=?, change_seq=? WHERE id=?",
+                         [(now, seq, r["id"]) for r in due])
+        deducted = {phone: round(before[phone] - balance, 2)
+                    for phone, balance in balances.items() if balance != before[phone]}
+        return ({"due": len(due), "own_account": own, "pooled": pooled, "deducted": deducted, "since": since},
+                float_shares.keys())
+
+    result, settled_phones = run_write(_run, db_name)
+    # Their "View Repayments" replies now show paid installments.
+    invalidate_phones(*settled_phones)
+    return result
+
+def reset_watermark(db_name=DB_NAME):
+    """Make the next run rescan every unpaid repayment that is due.
+
+    Needed after loading repayments whose due date is already in the past
+    (e.g. a bulk import), which the watermark would otherwise skip.
+    """
+    run_write(lambda conn: conn.execute("DELETE FROM job_state WHERE name=?", (WATERMARK,)), db_name)
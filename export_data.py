@@ -1,62 +1,218 @@
-import sqlite3
-import pandas as pd
-from datetime import datetime
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
 import os
-from database import get_momopays
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from openpyxl import Workbook
+from database import get_job_state, set_job_state
+from db_pool import DB_NAME, get_conn, run_write
+from metrics import EXPORT_DURATION, EXPORT_ROWS
+from migrations import CHANGE_SEQ_SQL
+from snapshot import snapshot_db
+from utils import parse_since
 
-DB_FILE = "users.db"
+# -------------------
+# STREAMING EXCEL EXPORT
+# -------------------
+# Each export streams rows into a write-only workbook, so memory stays flat
+# however large the table is. repayments (one row per loan-day) is the big
+# one. Rows are read in chunks, each a short query that resumes after the
+# last key written, so no read lock on users.db is held while openpyxl
+# writes the workbook.
+EXPORT_CHUNK_ROWS = 5000
+# Excel's hard limit, header row included. Longer exports continue on
+# Sheet2, Sheet3, ...
+EXCEL_MAX_ROWS = 1048576
 
-def export_to_excel():
-    try:
-        conn = sqlite3.connect(DB_FILE)
-
-        # -------------------
-        # Export Users
-        # -------------------
-        users_df = pd.read_sql_query("SELECT * FROM users", conn)
-
-        # -------------------
-        # Export Repayments
-        # -------------------
-        repayments_df = pd.read_sql_query("SELECT * FROM repayments", conn)
-
-        # -------------------
-        # Export MoMoPay
-        # -------------------
-        momopays = get_momopays()
-        momopays_df = pd.DataFrame(momopays)
-
-        # -------------------
-        # Save files with timestamp
-        # -------------------
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        users_file = f"registered_users_{timestamp}.xlsx"
-        repayments_file = f"scheduled_repayments_{timestamp}.xlsx"
-        momopays_file = f"momopays_{timestamp}.xlsx"
-
-        if not users_df.empty:
-            users_df.to_excel(users_file, index=False)
-            print(f"✅ Exported users to {users_file}")
-        else:
-            print("⚠️ No user data found to export.")
+# (label, file prefix, table or view, unique key the rows are ordered and
+# paged by)
+EXPORTS = [
+    ("users", "registered_users", "users", "id"),
+    # repayments_iso shows due dates as text, like the original column.
+    ("repayments", "scheduled_repayments", "repayments_iso", "id"),
+    ("MoMoPay", "momopays", "momopays", "phone"),
+]
 
-        if not repayments_df.empty:
-            repayments_df.to_excel(repayments_file, index=False)
-            print(f"✅ Exported repayments to {repayments_file}")
-        else:
-            print("⚠️ No repayment data found to export.")
+def export_query(source, key, filename, db_name=DB_NAME, max_rows_per_sheet=EXCEL_MAX_ROWS):
+    """Write every row of `source`, in `key` order, to an xlsx file; returns the number of rows.
 
-        if not momopays_df.empty:
-            momopays_df.to_excel(momopays_file, index=False)
-            print(f"✅ Exported MoMoPay data to {momopays_file}")
+    No file is written when there are no rows.
+    """
+    first_sql = f"SELECT * FROM {source} ORDER BY {key} LIMIT ?"
+    next_sql = f"SELECT * FROM {source} WHERE {key} > ? ORDER BY {key} LIMIT ?"
+    conn = get_conn(db_name)
+    header = None
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = written = 0
+    while True:
+        if written:
+            cursor = conn.execute(next_sql, (rows[-1][key], EXPORT_CHUNK_ROWS))
         else:
-            print("⚠️ No MoMoPay data found to export.")
+            cursor = conn.execute(first_sql, (EXPORT_CHUNK_ROWS,))
+        header = header or [col[0] for col in cursor.description]
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for row in rows:
+            if sheet is None or sheet_rows >= max_rows_per_sheet - 1:
+                sheet = workbook.create_sheet(f"Sheet{len(workbook.worksheets) + 1}")
+                sheet.append(header)
+                sheet_rows = 0
+            sheet.append(tuple(row))
+            sheet_rows += 1
+        written += len(rows)
+    if written:
+        workbook.save(filename)
+    return written
 
-        conn.close()
+def _run_export(job):
+    """Run one export job; returns (filename or None, seconds, rows).
 
+    Metrics are recorded by the caller: a worker process's registry is
+    lost when it exits.
+    """
+    label, source, key, filename, db_name, max_rows_per_sheet = job
+    started = time.perf_counter()
+    try:
+        rows = export_query(source, key, filename, db_name, max_rows_per_sheet)
     except Exception as e:
-        print(f"❌ Failed to export data: {e}")
+        print(f"❌ Failed to export {label}: {e}")
+        return None, None, 0
+    seconds = time.perf_counter() - started
+    if not rows:
+        print(f"⚠️ No {label} data found to export.")
+        return None, seconds, 0
+    print(f"✅ Exported {rows} {label} rows to {filename}")
+    return filename, seconds, rows
+
+def export_to_excel(parallel=False, max_rows_per_sheet=EXCEL_MAX_ROWS, db_name=DB_NAME, output_dir=""):
+    """Export users, repayments and MoMoPay accounts to timestamped files.
+
+    With parallel=True the three exports run in separate processes. Returns
+    the files written, under output_dir (default: the working directory).
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    jobs = [(label, source, key, os.path.join(output_dir, f"{prefix}_{timestamp}.xlsx"), db_name, max_rows_per_sheet)
+            for label, prefix, source, key in EXPORTS]
+    if parallel:
+        # Spawned, not forked: the report job calls this from a scheduler
+        # thread, and a forked child could inherit a lock another thread
+        # holds (sqlite, logging, the connection pool) and hang on it.
+        with ProcessPoolExecutor(max_workers=len(jobs), mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(_run_export, jobs))
+    else:
+        results = [_run_export(job) for job in jobs]
+    for job, (filename, seconds, rows) in zip(jobs, results):
+        if seconds is not None:
+            EXPORT_DURATION.observe(seconds, export=job[0])
+            EXPORT_ROWS.inc(rows, export=job[0])
+    return [filename for filename, _, _ in results if filename]
+
+# -------------------
+# DELTA EXPORTS
+# -------------------
+# Only the rows changed since the last export, found through the
+# change_seq columns and the deleted_rows tombstones (migrations 8 and 10),
+# written as CSV files plus a JSON manifest. An export reads the change
+# counter first and then every row up to it; a transaction still running
+# commits with a higher number, so it lands in the next export instead of
+# being skipped. Without an explicit start time, a run continues where the
+# last successful delta export stopped. Like export_query, each file is read
+# in short keyset pages, so no read lock is held while the CSV is written.
+#
+# (table, source, columns written, unique key the rows are ordered and
+# paged by, time column for an explicit start time)
+DELTA_EXPORTS = [
+    ("users", "users", "*", ("id",), "updated_at"),
+    ("repayments", "repayments_iso", "*", ("id",), "updated_at"),
+    ("momopays", "momopays", "*", ("phone",), "updated_at"),
+    ("deleted_rows", "deleted_rows", "table_name, row_key, deleted_at, change_seq", ("change_seq", "rowid"),
+     "deleted_at"),
+]
+# job_state key holding the change_seq the last successful delta export
+# reached.
+DELTA_STATE = "delta_export_seq"
+
+def export_delta(since=None, output_dir="", db_name=DB_NAME, state_key=DELTA_STATE):
+    """Write the changed rows and return the manifest path.
+
+    With since=None the export covers every change after the one the
+    previous export recorded under state_key (or all rows) and records its
+    own end; each consumer of deltas keeps its own key. With since (Unix
+    seconds) it covers rows written since then, once, and records nothing.
+    """
+    started = time.perf_counter()
+    conn = get_conn(db_name)
+    until_seq = conn.execute(f"SELECT {CHANGE_SEQ_SQL}").fetchone()[0]
+    if since is None:
+        since_seq = int(get_job_state(state_key, 0, conn=conn))
+        where, params, label = "change_seq > ? AND change_seq <= ?", (since_seq, until_seq), f"{since_seq}_{until_seq}"
+    else:
+        since_seq = None
+        where, params, label = "{time} >= ? AND change_seq <= ?", (since, until_seq), f"{since}s_{until_seq}"
+    files = []
+    for table, source, columns, key, time_column in DELTA_EXPORTS:
+        filename = os.path.join(output_dir, f"{table}_delta_{label}.csv")
+        # The key columns lead every row and are cut off before writing.
+        keys = ", ".join(key)
+        page_sql = (f"SELECT {keys}, {columns} FROM {source} WHERE {where.format(time=time_column)} {{after}} "
+                    f"ORDER BY {keys} LIMIT ?")
+        first_sql = page_sql.format(after="")
+        next_sql = page_sql.format(after=f"AND ({keys}) > ({', '.join('?' for _ in key)})")
+        digest = hashlib.sha256()
+        rows = 0
+        with open(filename, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            chunk = None
+            while True:
+                if chunk:
+                    cursor = conn.execute(next_sql, params + tuple(chunk[-1][:len(key)]) + (EXPORT_CHUNK_ROWS,))
+                else:
+                    cursor = conn.execute(first_sql, params + (EXPORT_CHUNK_ROWS,))
+                    writer.writerow([col[0] for col in cursor.description[len(key):]])
+                chunk = cursor.fetchall()
+                if not chunk:
+                    break
+                writer.writerows(tuple(row)[len(key):] for row in chunk)
+                rows += len(chunk)
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        files.append({"table": table, "file": os.path.basename(filename), "rows": rows, "sha256": digest.hexdigest()})
 
+    manifest = os.path.join(output_dir, f"manifest_{label}.json")
+    with open(manifest, "w") as f:
+        json.dump({
+            "since_seq": since_seq,
+            "until_seq": until_seq,
+            "since": since,
+            "since_local": datetime.fromtimestamp(since).strftime("%Y-%m-%d %H:%M:%S") if since is not None else None,
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "files": files,
+        }, f, indent=2)
+    if since is None:
+        run_write(lambda conn: set_job_state(state_key, until_seq, conn=conn), db_name)
+    total = sum(f["rows"] for f in files)
+    EXPORT_DURATION.observe(time.perf_counter() - started, export="delta")
+    EXPORT_ROWS.inc(total, export="delta")
+    print(f"✅ Exported {total} changed rows (up to change {until_seq}) to {manifest}")
+    return manifest
 
 if __name__ == "__main__":
-    export_to_excel()
+    parser = argparse.ArgumentParser(description="Export users, repayments and MoMoPay accounts to Excel")
+    parser.add_argument('--parallel', action='store_true', help='Run the three exports in parallel processes')
+    parser.add_argument('--max_rows_per_sheet', type=int, default=EXCEL_MAX_ROWS, help='Start a new sheet after this many rows (header included)')
+    parser.add_argument('--delta', action='store_true', help='Export only rows changed since the last delta export, as CSV with a manifest')
+    parser.add_argument('--since', help='With --delta: start from this time (Unix seconds or YYYY-MM-DD[ HH:MM:SS]) instead')
+    parser.add_argument('--output_dir', default="", help='Directory for the exported files')
+    args = parser.parse_args()
+    if args.delta:
+        export_delta(parse_since(args.since) if args.since else None, args.output_dir)
+    else:
+        export_to_excel(parallel=args.parallel, max_rows_per_sheet=args.max_rows_per_sheet, db_name=snapshot_db(),
+                        output_dir=args.output_dir)
@@ -1,66 +1,135 @@
-import sqlite3
 import argparse
+import time
 from math import ceil
-from database import search_users, get_repayments_by_user, get_momopays
+from database import get_dashboard_summary
+from db_pool import DB_NAME, get_conn
+from snapshot import snapshot_db
+import user_search
 from datetime import datetime
 
+# -------------------
+# QUERY BUILDER
+# -------------------
+# The CLI filters compile into one parameterized statement. Its inner
+# query finds the requested page of user ids, in sort order, from users
+# alone (plus momopays when the sort key needs it); the repayment totals
+# and MoMoPay balances are then joined in for those rows only. With the
+# filter indexes (migration 9) a page costs the same however many users
+# there are, except when sorting by a per-user aggregate, which has to be
+# computed for every matching user.
+TOTAL_PAID_SQL = "(SELECT COALESCE(SUM(r.amount), 0) FROM repayments r WHERE r.user_id = u.id AND +r.paid = 1)"
+# Next unpaid installment not yet due; NULL means "Completed".
+NEXT_DUE_SQL = "(SELECT MIN(r.due_ts) FROM repayments r WHERE r.user_id = u.id AND r.due_ts >= :now AND r.paid != 1)"
+
+# --sort_by value -> (SQL expression, needs the momopays join)
+SORT_KEYS = {
+    "id": ("u.id", False),
+    "full_name": ("u.full_name", False),
+    "phone": ("u.phone", False),
+    "national_id": ("u.national_id", False),
+    "loan_amount": ("u.loan_amount", False),
+    "duration": ("u.duration", False),
+    "date_registered": ("u.date_registered", False),
+    "total_paid": (TOTAL_PAID_SQL, False),
+    "remaining": (f"u.loan_amount - {TOTAL_PAID_SQL}", False),
+    # "Completed" sorts after every date, as the text did.
+    "next_due": (f"IFNULL({NEXT_DUE_SQL}, 9223372036854775807)", False),
+    "momo_balance": ("COALESCE(m.balance, 0)", True),
+    "float_shared": ("COALESCE(m.float_shared, 0)", True),
+}
+
+PAGE_SQL = """
+    WITH page AS (
+        SELECT u.id, {sort_key} AS sort_key
+        FROM users u {joins}
+        {where}
+        ORDER BY sort_key {order}, u.id
+        LIMIT :limit OFFSET :offset
+    )
+    SELECT u.id, u.full_name, u.phone, u.loan_amount, u.duration,
+           {total_paid} AS total_paid, {next_due} AS next_due_ts,
+           COALESCE(m.balance, 0) AS momo_balance, COALESCE(m.float_shared, 0) AS float_shared
+    FROM page
+    JOIN users u ON u.id = page.id
+    LEFT JOIN momopays m ON m.phone = u.phone
+    ORDER BY page.sort_key {order}, u.id
+"""
+
+def build_user_filter(show_unpaid_only=False, national_id=None, name=None, min_loan=None, max_loan=None,
+                      duration=None, db_name=DB_NAME):
+    """Return (where, params, summary_count) selecting the matching users as `u`.
+
+    summary_count names the get_dashboard_summary() counter that equals the
+    number of matches, when there is one.
+    """
+    conditions, params = [], {}
+    summary_count = "total_users"
+    if show_unpaid_only:
+        # loan_progress (migration 5) holds each user's unpaid installment
+        # count; users without a schedule count as fully paid. A per-user
+        # primary key lookup, so paging in id order stops after one page.
+        conditions.append("EXISTS (SELECT 1 FROM loan_progress lp WHERE lp.user_id = u.id AND lp.unpaid_count > 0)")
+        summary_count = "in_progress"
+    if national_id:
+        conditions.append("u.national_id = :national_id")
+        params["national_id"] = national_id
+    if name:
+        if len(name) >= user_search.FTS_MIN_CHARS and user_search.fts_available(db_name):
+            # Case-insensitive substring match on the name column only.
+            conditions.append("u.id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH :name)")
+            params["name"] = 'full_name : "' + name.replace('"', '""') + '"'
+        else:
+            conditions.append("u.full_name LIKE :name")
+            params["name"] = f"%{name}%"
+    if min_loan is not None:
+        conditions.append("u.loan_amount >= :min_loan")
+        params["min_loan"] = min_loan
+    if max_loan is not None:
+        conditions.append("u.loan_amount <= :max_loan")
+        params["max_loan"] = max_loan
+    if duration is not None:
+        conditions.append("u.duration = :duration")
+        params["duration"] = duration
+    if len(conditions) > int(show_unpaid_only):
+        summary_count = None
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, params, summary_count
+
+def build_page_query(where, params, sort_by="id", sort_order="asc", page=1, page_size=10):
+    """Return (sql, params) for one page of users with their totals and MoMoPay balance."""
+    if sort_by not in SORT_KEYS:
+        raise ValueError(f"cannot sort by {sort_by!r}; choose from {', '.join(SORT_KEYS)}")
+    sort_key, needs_momopay = SORT_KEYS[sort_by]
+    joins = "LEFT JOIN momopays m ON m.phone = u.phone" if needs_momopay else ""
+    sql = PAGE_SQL.format(sort_key=sort_key, joins=joins, where=where,
+                          order="DESC" if sort_order.lower() == "desc" else "ASC",
+                          total_paid=TOTAL_PAID_SQL, next_due=NEXT_DUE_SQL)
+    return sql, dict(params, now=int(time.time()), limit=page_size, offset=(page - 1) * page_size)
+
+def count_users(where, params, summary_count=None, db_name=DB_NAME):
+    if summary_count:
+        # Read from the portfolio_summary counters instead of counting.
+        return get_dashboard_summary(db_name)[summary_count]
+    return get_conn(db_name).execute(f"SELECT COUNT(*) FROM users u {where}", params).fetchone()[0]
+
+# -------------------
+# VIEW USERS
+# -------------------
 def view_users(show_unpaid_only=False, national_id=None, name=None, min_loan=None, max_loan=None, duration=None, sort_by='id', sort_order='asc', page=1, page_size=10):
     try:
-        users = search_users()
-        momopays = get_momopays()
-        today = datetime.now()
-
-        # Filter users
-        filtered = []
-        for u in users:
-            if show_unpaid_only:
-                repayments = get_repayments_by_user(u['id'])
-                if all(r['status'] == 'Paid' for r in repayments):
-                    continue
-
-            if national_id and u['national_id'] != national_id:
-                continue
-            if name and name.lower() not in u['full_name'].lower():
-                continue
-            if min_loan is not None and u['loan_amount'] < min_loan:
-                continue
-            if max_loan is not None and u['loan_amount'] > max_loan:
-                continue
-            if duration is not None and u['duration'] != duration:
-                continue
-
-            # Enrich with repayment info
-            repayments = get_repayments_by_user(u['id'])
-            total_paid = sum(r['amount'] for r in repayments if r['status'] == 'Paid')
-            u['total_paid'] = total_paid
-            u['remaining'] = u['loan_amount'] - total_paid
-
-            next_unpaid = None
-            for r in repayments:
-                due = datetime.strptime(r['due_date'], "%Y-%m-%d %H:%M:%S")
-                if r['status'] != 'Paid' and due >= today:
-                    if next_unpaid is None or due < next_unpaid:
-                        next_unpaid = due
-            u['next_due'] = next_unpaid.strftime("%Y-%m-%d %H:%M:%S") if next_unpaid else "Completed"
-
-            # MoMoPay info
-            momo = next((m for m in momopays if m['phone'] == u['phone']), None)
-            u['momo_balance'] = momo['balance'] if momo else 0
-            u['float_shared'] = momo['float_shared'] if momo else 0
-
-            filtered.append(u)
-
-        # Sort
-        filtered.sort(key=lambda x: x.get(sort_by, 0), reverse=(sort_order.lower()=='desc'))
+        # The count and the page come from one snapshot when those are enabled.
+        db_name = snapshot_db()
+        where, params, summary_count = build_user_filter(show_unpaid_only, national_id, name, min_loan, max_loan,
+                                                         duration, db_name)
 
         # Pagination
-        total_users = len(filtered)
+        total_users = count_users(where, params, summary_count, db_name)
         total_pages = max(1, ceil(total_users / page_size))
         if page < 1: page = 1
         elif page > total_pages: page = total_pages
-        start = (page-1)*page_size
-        end = start + page_size
-        page_users = filtered[start:end]
+
+        sql, page_params = build_page_query(where, params, sort_by, sort_order, page, page_size)
+        page_users = get_conn(db_name).execute(sql, page_params).fetchall()
 
         if not page_users:
             print("⚠️ No users found matching criteria.")
@@ -68,8 +137,9 @@ def view_users(show_unpaid_only=False, national_id=None, name=None, min_loan=Non
 
         print(f"📋 Registered Users (Page {page} of {total_pages}):\n")
         for u in page_users:
+            next_due = datetime.fromtimestamp(u['next_due_ts']).strftime("%Y-%m-%d %H:%M:%S") if u['next_due_ts'] else "Completed"
             print(f"ID: {u['id']}, Name: {u['full_name']}, Phone: {u['phone']}, Loan: {u['loan_amount']}, Duration: {u['duration']} days")
-            print(f"Total Paid: {u['total_paid']}, Remaining: {u['remaining']}, Next Due: {u['next_due']}")
+            print(f"Total Paid: {u['total_paid']}, Remaining: {u['loan_amount'] - u['total_paid']}, Next Due: {next_due}")
             print(f"MoMo Balance: {u['momo_balance']}, Float Shared: {u['float_shared']}")
             print("-"*50)
 
@@ -86,7 +156,7 @@ if __name__ == "__main__":
     parser.add_argument('--min_loan', type=float, help='Filter users with loan amount >= value')
     parser.add_argument('--max_loan', type=float, help='Filter users with loan amount <= value')
     parser.add_argument('--duration', type=int, help='Filter users with exact loan duration')
-    parser.add_argument('--sort_by', type=str, default='id', help='Sort by field: id, full_name, loan_amount, duration')
+    parser.add_argument('--sort_by', type=str, default='id', help='Sort by field: ' + ', '.join(SORT_KEYS))
     parser.add_argument('--sort_order', type=str, default='asc', help='Sort order: asc or desc')
     parser.add_argument('--page', type=int, default=1, help='Page number')
     parser.add_argument('--page_size', type=int, default=10, help='Users per page')
@@ -0,0 +1,9 @@
+from session_store import check_workers
+
+# -------------------
+# GUNICORN HOOKS
+# -------------------
+# Read by gunicorn from the working directory (see Procfile).
+def on_starting(server):
+    # In-progress USSD registrations must reach every worker.
+    check_workers(server.cfg.workers)
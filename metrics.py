@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# ----------------------
+# CONFIGURATION
+# ----------------------
+# Metrics are on by default; USSD_METRICS=0 turns off the SQL timing and the
+# Flask hooks. Every recording is a few additions under a lock, so it is
+# cheap enough to leave on in production.
+METRICS_ENABLED = os.environ.get("USSD_METRICS", "1").lower() not in ("0", "false", "no", "off")
+
+# Seconds. USSD gateways time out after a few seconds; batch jobs and
+# exports can take minutes.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+SQL_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 1000, 10000)
+
+# ----------------------
+# METRIC TYPES
+# ----------------------
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+# ----------------------
+# METRICS
+# ----------------------
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Time to build the response, per route.",
+                         ("route", "method", "status"))
+USSD_STEP_LATENCY = Histogram("ussd_step_duration_seconds", "Time to answer one /ussd request, per menu step.",
+                              ("step",))
+SQL_PER_REQUEST = Histogram("http_request_sql_statements", "SQL statements issued while handling one request.",
+                            ("route",), SQL_COUNT_BUCKETS)
+SQL_TIME_PER_REQUEST = Histogram("http_request_sql_seconds", "Time spent in SQLite while handling one request.",
+                                 ("route",))
+SQL_STATEMENTS = Counter("sqlite_statements_total", "SQL statements executed by this process.")
+SQL_SECONDS = Counter("sqlite_seconds_total", "Time spent executing SQL statements in this process.")
+JOB_DURATION = Histogram("job_duration_seconds", "Scheduler job run time.", ("job",), JOB_BUCKETS)
+JOB_ITEMS = Counter("job_items_total", "Items processed by scheduler jobs.", ("job",))
+EXPORT_DURATION = Histogram("export_duration_seconds", "Time to write one export.", ("export",), JOB_BUCKETS)
+EXPORT_ROWS = Counter("export_rows_total", "Rows written by exports.", ("export",))
+EMAIL_DURATION = Histogram("email_duration_seconds", "Time to send one report email.", ("outcome",), JOB_BUCKETS)
+
+REGISTRY = [HTTP_LATENCY, USSD_STEP_LATENCY, SQL_PER_REQUEST, SQL_TIME_PER_REQUEST, SQL_STATEMENTS,
+            SQL_SECONDS, JOB_DURATION, JOB_ITEMS, EXPORT_DURATION, EXPORT_ROWS, EMAIL_DURATION]
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# ----------------------
+# SQL ACCOUNTING
+# ----------------------
+# Statement counts and time per thread, so a request can tell how much SQL
+# it issued. db_pool calls record_sql() around every execute.
+_sql = threading.local()
+
+def record_sql(seconds, statements=1):
+    _sql.count = getattr(_sql, "count", 0) + statements
+    _sql.seconds = getattr(_sql, "seconds", 0.0) + seconds
+    SQL_STATEMENTS.inc(statements)
+    SQL_SECONDS.inc(seconds)
+
+def attribute_sql(statements, seconds):
+    """Charge SQL run on another thread (the WAL writer) to this thread."""
+    _sql.count = getattr(_sql, "count", 0) + statements
+    _sql.seconds = getattr(_sql, "seconds", 0.0) + seconds
+
+def sql_snapshot():
+    return getattr(_sql, "count", 0), getattr(_sql, "seconds", 0.0)
+
+# ----------------------
+# HELPERS
+# ----------------------
+@contextmanager
+def timed(histogram, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+def observe_job(job, seconds, items=0):
+    JOB_DURATION.observe(seconds, job=job)
+    JOB_ITEMS.inc(items, job=job)
+
+# ----------------------
+# FLASK INTEGRATION
+# ----------------------
+def init_app(app):
+    """Time every request and serve the metrics on /metrics.
+
+    A view can set g.ussd_step to also record its latency per USSD step.
+    Streamed responses (/export) are timed until their headers are ready;
+    the export itself is recorded in export_duration_seconds.
+    """
+    from flask import Response, g, request
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_sql = sql_snapshot()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_LATENCY.observe(elapsed, route=route, method=request.method, status=response.status_code)
+        step = g.pop("ussd_step", None)
+        if step:
+            USSD_STEP_LATENCY.observe(elapsed, step=step)
+        count, seconds = sql_snapshot()
+        before_count, before_seconds = g.pop("metrics_sql")
+        SQL_PER_REQUEST.observe(count - before_count, route=route)
+        SQL_TIME_PER_REQUEST.observe(seconds - before_seconds, route=route)
+        return response
@@ -0,0 +1,562 @@
+import sqlite3
+
+from db_pool import DB_NAME, get_conn, run_write
+
+# ----------------------
+# SCHEMA MIGRATIONS
+# ----------------------
+# Each migration runs once per database, in order, inside its own write
+# transaction. PRAGMA user_version records the last one applied, so any
+# database created by the older init scripts (app.py, database.py,
+# init_db_runner.py, migrate_db.py) converges on the same schema.
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def _table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() is not None
+
+def _unique_indexes_on(conn, table, column):
+    """Names of the UNIQUE indexes (constraints included) on exactly `column`."""
+    return [index["name"] for index in conn.execute(f"PRAGMA index_list({table})")
+            if index["unique"] and [col["name"] for col in conn.execute(f"PRAGMA index_info({index['name']})")] == [column]]
+
+def _baseline(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        phone TEXT UNIQUE,
+        national_id TEXT,
+        full_name TEXT,
+        address TEXT,
+        father_name TEXT,
+        mother_name TEXT,
+        loan_amount REAL,
+        duration INTEGER,
+        date_registered TEXT
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS repayments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        due_date TEXT,
+        paid INTEGER DEFAULT 0
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ussd_sessions (
+        session_id TEXT PRIMARY KEY,
+        phone TEXT,
+        step INTEGER DEFAULT 0,
+        national_id TEXT,
+        full_name TEXT,
+        address TEXT,
+        father_name TEXT,
+        mother_name TEXT,
+        loan_amount REAL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS momopays (
+        phone TEXT PRIMARY KEY,
+        balance REAL DEFAULT 0,
+        float_shared REAL DEFAULT 0,
+        merged_batch REAL DEFAULT 0
+    )
+    """)
+
+    # Old databases created before date_registered existed.
+    if "date_registered" not in _columns(conn, "users"):
+        conn.execute("ALTER TABLE users ADD COLUMN date_registered TEXT")
+
+    # migrate_db.py added a 'status' copy of 'paid' that nothing kept in
+    # sync. 'paid' is the column every writer updates.
+    if "status" in _columns(conn, "repayments"):
+        try:
+            conn.execute("ALTER TABLE repayments DROP COLUMN status")
+        except sqlite3.OperationalError as e:
+            # SQLite older than 3.35: the column stays behind, unused (it
+            # has a default, so inserts that leave it out still work).
+            print(f"⚠️ Keeping unused repayments.status column: {e}")
+
+    # migrate_db.py created a singular 'momopay' table.
+    if _table_exists(conn, "momopay"):
+        conn.execute("""
+            INSERT OR IGNORE INTO momopays (phone, balance, float_shared, merged_batch)
+            SELECT phone, balance, float_shared, merged_batch FROM momopay
+        """)
+        conn.execute("DROP TABLE momopay")
+
+def _hot_path_indexes(conn):
+    # get_repayments_by_user: WHERE user_id=? ORDER BY due_date, and the
+    # selected columns come straight from the index.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_repayments_user_due ON repayments (user_id, due_date, paid, amount)")
+    # Scheduler scan: unpaid repayments due before now.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_repayments_paid_due ON repayments (paid, due_date, user_id, amount)")
+    # get_user_by_phone. Databases created by init_db_runner.py have no
+    # UNIQUE constraint on phone, so this index is not unique either (until
+    # migration 14 replaces it); the others already have the constraint's index.
+    if not _unique_indexes_on(conn, "users", "phone"):
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_phone ON users (phone)")
+    # ussd_sessions is keyed by its session_id PRIMARY KEY already.
+
+def _user_search_index(conn):
+    # Trigram full-text index over the searchable user columns. It is an
+    # external-content table, so it stores only the index and reads the text
+    # back from users; the triggers keep it in sync with every write path.
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                full_name, phone, national_id,
+                content='users', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5 (or older than 3.34): search falls back
+        # to LIKE scans.
+        print(f"⚠️ Skipping users_fts search index: {e}")
+        return
+    for sql in USERS_FTS_TRIGGERS:
+        conn.execute(sql)
+    conn.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+
+USERS_FTS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, full_name, phone, national_id)
+        VALUES (new.id, new.full_name, new.phone, new.national_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, full_name, phone, national_id)
+        VALUES ('delete', old.id, old.full_name, old.phone, old.national_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF full_name, phone, national_id ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, full_name, phone, national_id)
+        VALUES ('delete', old.id, old.full_name, old.phone, old.national_id);
+        INSERT INTO users_fts (rowid, full_name, phone, national_id)
+        VALUES (new.id, new.full_name, new.phone, new.national_id);
+    END
+    """,
+)
+
+def _job_state(conn):
+    # Small key/value table for state that background jobs persist between
+    # runs (e.g. the auto-deduction watermark).
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS job_state (
+        name TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+
+def rebuild_portfolio_summary(conn):
+    """Recompute the portfolio counters from users and repayments."""
+    conn.execute("DELETE FROM loan_progress")
+    conn.execute("""
+        INSERT INTO loan_progress (user_id, unpaid_count)
+        SELECT u.id, (SELECT COUNT(*) FROM repayments r WHERE r.user_id = u.id AND r.paid != 1)
+        FROM users u
+    """)
+    conn.execute("DELETE FROM portfolio_summary")
+    conn.execute("""
+        INSERT INTO portfolio_summary (id, total_users, total_loans, completed_users, outstanding_balance)
+        SELECT 1,
+               (SELECT COUNT(*) FROM users),
+               (SELECT COALESCE(SUM(loan_amount), 0) FROM users),
+               (SELECT COUNT(*) FROM loan_progress WHERE unpaid_count = 0),
+               (SELECT COALESCE(SUM(amount), 0) FROM repayments WHERE paid != 1)
+    """)
+
+def _portfolio_summary(conn):
+    # Dashboard counters kept current by triggers, so every write path
+    # (app, database.py, scheduler, admin edits) updates them. loan_progress
+    # holds each user's unpaid installment count, which tells when a user
+    # moves between completed and in progress.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS portfolio_summary (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_users INTEGER NOT NULL DEFAULT 0,
+        total_loans REAL NOT NULL DEFAULT 0,
+        completed_users INTEGER NOT NULL DEFAULT 0,
+        outstanding_balance REAL NOT NULL DEFAULT 0
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS loan_progress (
+        user_id INTEGER PRIMARY KEY,
+        unpaid_count INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    for sql in PORTFOLIO_SUMMARY_TRIGGERS:
+        conn.execute(sql)
+    rebuild_portfolio_summary(conn)
+
+# A repayment update is applied as "remove the old row, add the new one";
+# the two halves commute, so trigger firing order does not matter.
+PORTFOLIO_SUMMARY_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS summary_user_insert AFTER INSERT ON users BEGIN
+        INSERT OR IGNORE INTO loan_progress (user_id, unpaid_count) VALUES (new.id, 0);
+        UPDATE portfolio_summary SET
+            total_users = total_users + 1,
+            total_loans = total_loans + COALESCE(new.loan_amount, 0),
+            completed_users = completed_users + (SELECT COUNT(*) FROM loan_progress WHERE user_id = new.id AND unpaid_count = 0);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS summary_user_delete AFTER DELETE ON users BEGIN
+        UPDATE portfolio_summary SET
+            total_users = total_users - 1,
+            total_loans = total_loans - COALESCE(old.loan_amount, 0),
+            completed_users = completed_users - (SELECT COUNT(*) FROM loan_progress WHERE user_id = old.id AND unpaid_count = 0);
+        DELETE FROM loan_progress WHERE user_id = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS summary_user_loan_update AFTER UPDATE OF loan_amount ON users BEGIN
+        UPDATE portfolio_summary SET
+            total_loans = total_loans - COALESCE(old.loan_amount, 0) + COALESCE(new.loan_amount, 0);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS summary_repayment_insert AFTER INSERT ON repayments WHEN new.paid != 1 BEGIN
+        UPDATE portfolio_summary SET
+            outstanding_balance = outstanding_balance + COALESCE(new.amount, 0),
+            completed_users = completed_users - (SELECT COUNT(*) FROM loan_progress WHERE user_id = new.user_id AND unpaid_count = 0);
+        UPDATE loan_progress SET unpaid_count = unpaid_count + 1 WHERE user_id = new.user_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS summary_repayment_delete AFTER DELETE ON repayments WHEN old.paid != 1 BEGIN
+        UPDATE loan_progress SET unpaid_count = unpaid_count - 1 WHERE user_id = old.user_id;
+        UPDATE portfolio_summary SET
+            outstanding_balance = outstanding_balance - COALESCE(old.amount, 0),
+            completed_users = completed_users + (SELECT COUNT(*) FROM loan_progress WHERE user_id = old.user_id AND unpaid_count = 0);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS summary_repayment_update_old AFTER UPDATE OF paid, amount, user_id ON repayments WHEN old.paid != 1 BEGIN
+        UPDATE loan_progress SET unpaid_count = unpaid_count - 1 WHERE user_id = old.user_id;
+        UPDATE portfolio_summary SET
+            outstanding_balance = outstanding_balance - COALESCE(old.amount, 0),
+            completed_users = completed_users + (SELECT COUNT(*) FROM loan_progress WHERE user_id = old.user_id AND unpaid_count = 0);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS summary_repayment_update_new AFTER UPDATE OF paid, amount, user_id ON repayments WHEN new.paid != 1 BEGIN
+        UPDATE portfolio_summary SET
+            outstanding_balance = outstanding_balance + COALESCE(new.amount, 0),
+            completed_users = completed_users - (SELECT COUNT(*) FROM loan_progress WHERE user_id = new.user_id AND unpaid_count = 0);
+        UPDATE loan_progress SET unpaid_count = unpaid_count + 1 WHERE user_id = new.user_id;
+    END
+    """,
+)
+
+def _epoch_due_dates(conn):
+    # Due dates become integer Unix timestamps (due_ts). Overdue, next-due
+    # and countdown checks are then integer comparisons inside SQL, and the
+    # text is only formatted when a page is rendered. The old values are
+    # local wall-clock times, hence the 'utc' conversion.
+    if "due_ts" not in _columns(conn, "repayments"):
+        conn.execute("ALTER TABLE repayments ADD COLUMN due_ts INTEGER")
+    conn.execute("UPDATE repayments SET due_ts = CAST(strftime('%s', due_date, 'utc') AS INTEGER) WHERE due_ts IS NULL")
+    conn.execute("DROP INDEX IF EXISTS idx_repayments_user_due")
+    conn.execute("DROP INDEX IF EXISTS idx_repayments_paid_due")
+    try:
+        conn.execute("ALTER TABLE repayments DROP COLUMN due_date")
+    except sqlite3.OperationalError as e:
+        # SQLite older than 3.35: the column stays behind, unused.
+        print(f"⚠️ Keeping unused repayments.due_date column: {e}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_repayments_user_due ON repayments (user_id, due_ts, paid, amount)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_repayments_paid_due ON repayments (paid, due_ts, user_id, amount)")
+    # The old row shape, for exports and anything else that reads dates as
+    # text.
+    conn.execute("""
+    CREATE VIEW IF NOT EXISTS repayments_iso AS
+    SELECT id, user_id, amount,
+           strftime('%Y-%m-%d %H:%M:%S', due_ts, 'unixepoch', 'localtime') AS due_date,
+           paid
+    FROM repayments
+    """)
+    # deduction.WATERMARK holds a due date too.
+    conn.execute("""
+        UPDATE job_state SET value = CAST(strftime('%s', value, 'utc') AS INTEGER)
+        WHERE name = 'auto_deduction_watermark' AND value LIKE '____-__-__ __:__:__'
+    """)
+
+def _email_outbox(conn):
+    # Report emails queued by report_pipeline.py. A row is retried until it
+    # is sent or runs out of attempts; attachments is a JSON list of paths.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS email_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_ts INTEGER NOT NULL,
+        subject TEXT NOT NULL,
+        attachments TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_ts INTEGER NOT NULL,
+        last_error TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_pending ON email_outbox (status, next_attempt_ts)")
+
+# Change tracking for delta exports: every row carries updated_at (Unix
+# seconds), and deleted rows leave a tombstone. Triggers stamp any insert
+# or update that does not set updated_at itself; the bulk write paths
+# (schedules, deductions, imports) set it in the statement and skip the
+# extra write.
+TRACKED_TABLES = (("users", "id"), ("repayments", "id"), ("momopays", "phone"))
+NOW_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+def _change_tracking(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS deleted_rows (
+        table_name TEXT NOT NULL,
+        row_key TEXT NOT NULL,
+        deleted_at INTEGER NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_deleted_rows_time ON deleted_rows (deleted_at)")
+    for table, key in TRACKED_TABLES:
+        if "updated_at" not in _columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN updated_at INTEGER")
+        conn.execute(f"UPDATE {table} SET updated_at = {NOW_SQL} WHERE updated_at IS NULL")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_updated ON {table} (updated_at)")
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_touch_insert AFTER INSERT ON {table} WHEN new.updated_at IS NULL BEGIN
+            UPDATE {table} SET updated_at = {NOW_SQL} WHERE {key} = new.{key};
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_touch_update AFTER UPDATE ON {table}
+        WHEN new.updated_at IS old.updated_at BEGIN
+            UPDATE {table} SET updated_at = {NOW_SQL} WHERE {key} = new.{key};
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_tombstone AFTER DELETE ON {table} BEGIN
+            INSERT INTO deleted_rows (table_name, row_key, deleted_at) VALUES ('{table}', old.{key}, {NOW_SQL});
+        END
+        """)
+    # repayments_iso gains the column too.
+    conn.execute("DROP VIEW IF EXISTS repayments_iso")
+    conn.execute("""
+    CREATE VIEW repayments_iso AS
+    SELECT id, user_id, amount,
+           strftime('%Y-%m-%d %H:%M:%S', due_ts, 'unixepoch', 'localtime') AS due_date,
+           paid, updated_at
+    FROM repayments
+    """)
+
+def _user_filter_indexes(conn):
+    # export_users.py filters and sorts in SQL: exact national ID, loan
+    # ranges, durations, and paging in name or loan order.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_national_id ON users (national_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_loan_amount ON users (loan_amount)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_duration ON users (duration, loan_amount)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_full_name ON users (full_name)")
+
+# Change sequence for delta exports. updated_at is taken when a write
+# starts, so a transaction that commits late can stamp rows with a time an
+# export has already passed. Writes to SQLite are serialized, so a counter
+# bumped inside every write transaction grows in commit order instead: an
+# export that reads the counter and then every row up to it can never miss
+# a later commit. Each tracked row and tombstone carries the change_seq of
+# its last write; the triggers stamp rows written without one, and the
+# bulk write paths take one number per transaction with next_change_seq().
+CHANGE_SEQ_SQL = "(SELECT seq FROM change_counter WHERE id = 1)"
+
+def next_change_seq(conn):
+    """Bump the change counter inside conn's write transaction and return it."""
+    conn.execute("UPDATE change_counter SET seq = seq + 1 WHERE id = 1")
+    return conn.execute("SELECT seq FROM change_counter WHERE id = 1").fetchone()[0]
+
+def _change_sequence(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS change_counter (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        seq INTEGER NOT NULL
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO change_counter (id, seq) VALUES (1, 1)")
+    # Existing rows all count as the first change.
+    for table, key in TRACKED_TABLES + (("deleted_rows", "rowid"),):
+        if "change_seq" not in _columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN change_seq INTEGER")
+        conn.execute(f"UPDATE {table} SET change_seq = 1 WHERE change_seq IS NULL")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_change_seq ON {table} (change_seq)")
+    for table, key in TRACKED_TABLES:
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_touch_insert")
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_touch_update")
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_tombstone")
+        conn.execute(f"""
+        CREATE TRIGGER {table}_touch_insert AFTER INSERT ON {table} WHEN new.change_seq IS NULL BEGIN
+            UPDATE change_counter SET seq = seq + 1 WHERE id = 1;
+            UPDATE {table} SET updated_at = COALESCE(new.updated_at, {NOW_SQL}), change_seq = {CHANGE_SEQ_SQL}
+            WHERE {key} = new.{key};
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER {table}_touch_update AFTER UPDATE ON {table} WHEN new.change_seq IS old.change_seq BEGIN
+            UPDATE change_counter SET seq = seq + 1 WHERE id = 1;
+            UPDATE {table} SET
+                updated_at = CASE WHEN new.updated_at IS old.updated_at THEN {NOW_SQL} ELSE new.updated_at END,
+                change_seq = {CHANGE_SEQ_SQL}
+            WHERE {key} = new.{key};
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER {table}_tombstone AFTER DELETE ON {table} BEGIN
+            UPDATE change_counter SET seq = seq + 1 WHERE id = 1;
+            INSERT INTO deleted_rows (table_name, row_key, deleted_at, change_seq)
+            VALUES ('{table}', old.{key}, {NOW_SQL}, {CHANGE_SEQ_SQL});
+        END
+        """)
+    conn.execute("DROP VIEW IF EXISTS repayments_iso")
+    conn.execute("""
+    CREATE VIEW repayments_iso AS
+    SELECT id, user_id, amount,
+           strftime('%Y-%m-%d %H:%M:%S', due_ts, 'unixepoch', 'localtime') AS due_date,
+           paid, updated_at, change_seq
+    FROM repayments
+    """)
+
+def _ussd_session_answers(conn):
+    # Registration answers live in one JSON object, so ussd_menu.json can ask
+    # for any borrower field without a column per field. Sessions last a few
+    # minutes; ones in flight during the upgrade start again.
+    if "answers" not in _columns(conn, "ussd_sessions"):
+        conn.execute("ALTER TABLE ussd_sessions ADD COLUMN answers TEXT")
+
+def _drop_duplicate_phone_index(conn):
+    # Migration 2 used to add idx_users_phone next to the UNIQUE constraint's
+    # own index; every users write paid for both.
+    if _unique_indexes_on(conn, "users", "phone"):
+        conn.execute("DROP INDEX IF EXISTS idx_users_phone")
+
+# Bulk loads (bulk_import.py, the synthetic portfolio generator) maintain
+# users_fts, loan_progress and portfolio_summary with one set-based
+# statement per batch instead of these per-row insert triggers. They set
+# bulk_load.active inside their write transaction and clear it before
+# commit, so the triggers skip only that transaction's rows: no other
+# connection ever sees the flag set, and no schema change is made.
+BULK_LOAD_GUARD = "(SELECT active FROM bulk_load WHERE id = 1) IS NOT 1"
+
+BULK_LOAD_TRIGGERS = {
+    "users_fts_insert": f"""
+    CREATE TRIGGER users_fts_insert AFTER INSERT ON users WHEN {BULK_LOAD_GUARD} BEGIN
+        INSERT INTO users_fts (rowid, full_name, phone, national_id)
+        VALUES (new.id, new.full_name, new.phone, new.national_id);
+    END
+    """,
+    "summary_user_insert": f"""
+    CREATE TRIGGER summary_user_insert AFTER INSERT ON users WHEN {BULK_LOAD_GUARD} BEGIN
+        INSERT OR IGNORE INTO loan_progress (user_id, unpaid_count) VALUES (new.id, 0);
+        UPDATE portfolio_summary SET
+            total_users = total_users + 1,
+            total_loans = total_loans + COALESCE(new.loan_amount, 0),
+            completed_users = completed_users + (SELECT COUNT(*) FROM loan_progress WHERE user_id = new.id AND unpaid_count = 0);
+    END
+    """,
+    "summary_repayment_insert": f"""
+    CREATE TRIGGER summary_repayment_insert AFTER INSERT ON repayments WHEN new.paid != 1 AND {BULK_LOAD_GUARD} BEGIN
+        UPDATE portfolio_summary SET
+            outstanding_balance = outstanding_balance + COALESCE(new.amount, 0),
+            completed_users = completed_users - (SELECT COUNT(*) FROM loan_progress WHERE user_id = new.user_id AND unpaid_count = 0);
+        UPDATE loan_progress SET unpaid_count = unpaid_count + 1 WHERE user_id = new.user_id;
+    END
+    """,
+}
+
+def set_bulk_load(conn, active):
+    """Switch the BULK_LOAD_TRIGGERS off (True) or back on inside conn's write transaction."""
+    conn.execute("UPDATE bulk_load SET active = ? WHERE id = 1", (int(active),))
+
+def _bulk_load_switch(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS bulk_load (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        active INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO bulk_load (id, active) VALUES (1, 0)")
+    for name, sql in BULK_LOAD_TRIGGERS.items():
+        # users_fts_insert only exists where FTS5 does (migration 3).
+        if name == "users_fts_insert" and not _table_exists(conn, "users_fts"):
+            continue
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(sql)
+
+def _unique_phone(conn):
+    # Databases created by init_db_runner.py have no UNIQUE constraint on
+    # phone (migration 2 gave them a plain idx_users_phone instead). Give
+    # them a unique index so every database enforces one borrower per phone.
+    # Duplicates are not merged here: each row has its own loan and
+    # repayments, so they are reported and the migration fails until an
+    # operator resolves them.
+    if _unique_indexes_on(conn, "users", "phone"):
+        return
+    duplicates = conn.execute("""
+    SELECT phone, group_concat(id, ', ') FROM users
+    WHERE phone IS NOT NULL
+    GROUP BY phone HAVING COUNT(*) > 1
+    ORDER BY phone
+    """).fetchall()
+    if duplicates:
+        for phone, ids in duplicates:
+            print(f"❌ Phone {phone} is shared by users {ids}")
+        raise RuntimeError(
+            f"{len(duplicates)} phone numbers belong to more than one user; "
+            "merge or remove the duplicates, then run the migrations again"
+        )
+    conn.execute("DROP INDEX IF EXISTS idx_users_phone")
+    conn.execute("CREATE UNIQUE INDEX idx_users_phone_unique ON users (phone)")
+
+MIGRATIONS = [
+    (1, "baseline schema", _baseline),
+    (2, "hot-path indexes", _hot_path_indexes),
+    (3, "user search index", _user_search_index),
+    (4, "job state", _job_state),
+    (5, "portfolio summary counters", _portfolio_summary),
+    (6, "integer due dates", _epoch_due_dates),
+    (7, "email outbox", _email_outbox),
+    (8, "change tracking", _change_tracking),
+    (9, "user filter indexes", _user_filter_indexes),
+    (10, "change sequence", _change_sequence),
+    (11, "USSD session answers", _ussd_session_answers),
+    (12, "drop duplicate phone index", _drop_duplicate_phone_index),
+    (13, "bulk load switch", _bulk_load_switch),
+    (14, "unique borrower phones", _unique_phone),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(db_name=DB_NAME):
+    return get_conn(db_name).execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(db_name=DB_NAME, verbose=False):
+    """Apply every pending migration and return the resulting version."""
+    for version, description, step in MIGRATIONS:
+        def _apply(conn):
+            # Re-read inside the write lock: another worker may have
+            # applied this migration while we were waiting.
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                return False
+            step(conn)
+            conn.execute(f"PRAGMA user_version={version}")
+            return True
+        if get_schema_version(db_name) < version and run_write(_apply, db_name) and verbose:
+            print(f"✅ Applied migration {version}: {description}")
+    return get_schema_version(db_name)
+
+
+if __name__ == "__main__":
+    print(f"✅ Database schema at version {migrate(verbose=True)}.")
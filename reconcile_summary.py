@@ -0,0 +1,10 @@
+from database import reconcile_portfolio_summary
+
+def reconcile():
+    # The dashboard counters are kept up to date by triggers; this recomputes
+    # them from users and repayments in case they ever drift.
+    summary = reconcile_portfolio_summary()
+    print(f"✅ Portfolio summary rebuilt: {summary}")
+
+if __name__ == "__main__":
+    reconcile()
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from database import get_job_state, set_job_state
+from db_pool import BASE_DIR, DB_NAME, get_conn, run_write
+from export_data import export_delta, export_to_excel
+from metrics import observe_job
+from snapshot import snapshot_db
+import send_email
+
+# -------------------
+# REPORT PIPELINE
+# -------------------
+# Builds the Excel reports and emails them on its own cadence, away from
+# the deduction job. A cycle only re-exports when the data changed since
+# the last export, the exports run in worker processes, and emails go
+# through an outbox table (migration 7) that is retried with backoff by a
+# small pool of sender threads. Run it inside the scheduler process
+# (start_report_jobs) or on its own:
+#
+#     python report_pipeline.py            # every REPORT_INTERVAL_MINUTES
+#     python report_pipeline.py --once --force
+REPORT_INTERVAL_MINUTES = int(os.environ.get("USSD_REPORT_INTERVAL_MINUTES", "60"))
+REPORT_DIR = os.environ.get("USSD_REPORT_DIR") or os.path.join(BASE_DIR, "reports")
+# "full" mails the Excel workbooks; "delta" mails only the rows changed
+# since the previous report, as CSV files with a manifest.
+REPORT_MODE = os.environ.get("USSD_REPORT_MODE", "full")
+# At most this many SMTP sessions at once.
+EMAIL_WORKERS = int(os.environ.get("USSD_EMAIL_WORKERS", "2"))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get("USSD_EMAIL_MAX_ATTEMPTS", "5"))
+# Retries wait 1, 2, 4, ... minutes.
+EMAIL_RETRY_BASE_SECONDS = 60
+# A claimed message is hidden from other senders this long; a sender that
+# dies mid-send leaves it to be retried afterwards.
+EMAIL_LEASE_SECONDS = send_email.SMTP_TIMEOUT_SECONDS * 2
+
+# job_state keys: the fingerprint of the last exported data, and the
+# change_seq the last delta report reached.
+FINGERPRINT = "report_fingerprint"
+DELTA_STATE = "report_delta_seq"
+
+# The change counter (migration 10) moves whenever any borrower, schedule,
+# payment or balance is written or deleted.
+FINGERPRINT_SQL = "SELECT seq FROM change_counter WHERE id = 1"
+
+def data_fingerprint(db_name=DB_NAME):
+    return json.dumps(list(get_conn(db_name).execute(FINGERPRINT_SQL).fetchone()))
+
+# -------------------
+# OUTBOX
+# -------------------
+def enqueue_report(attachments, subject=send_email.REPORT_SUBJECT, supersede=True, db_name=DB_NAME):
+    """Queue a report email.
+
+    With supersede, an older report with the same subject still waiting
+    is dropped; deltas pass False since each one carries its own changes.
+    """
+    now = int(time.time())
+
+    def _enqueue(conn):
+        if not supersede:
+            superseded = []
+        else:
+            superseded = conn.execute("SELECT attachments FROM email_outbox WHERE status='pending' AND subject=?",
+                                      (subject,)).fetchall()
+            conn.execute("UPDATE email_outbox SET status='superseded' WHERE status='pending' AND subject=?", (subject,))
+        conn.execute("""
+            INSERT INTO email_outbox (created_ts, subject, attachments, next_attempt_ts) VALUES (?, ?, ?, ?)
+        """, (now, subject, json.dumps(list(attachments)), now))
+        return [json.loads(row[0]) for row in superseded]
+
+    for files in run_write(_enqueue, db_name):
+        _remove_reports(files)
+
+def _claim_due(limit, db_name):
+    now = int(time.time())
+
+    def _claim(conn):
+        rows = conn.execute("""
+            SELECT id, subject, attachments, attempts FROM email_outbox
+            WHERE status='pending' AND next_attempt_ts <= ? ORDER BY id LIMIT ?
+        """, (now, limit)).fetchall()
+        conn.executemany("UPDATE email_outbox SET attempts = attempts + 1, next_attempt_ts = ? WHERE id=?",
+                         [(now + EMAIL_LEASE_SECONDS, row["id"]) for row in rows])
+        return [dict(row) for row in rows]
+
+    return run_write(_claim, db_name)
+
+def _send(message, db_name):
+    attempts = message["attempts"] + 1
+    files = json.loads(message["attachments"])
+    try:
+        send_email.deliver(send_email.build_report_message(files, message["subject"]))
+    except Exception as e:
+        give_up = attempts >= EMAIL_MAX_ATTEMPTS
+        retry_at = int(time.time()) + EMAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+        run_write(lambda conn: conn.execute(
+            "UPDATE email_outbox SET status=?, next_attempt_ts=?, last_error=? WHERE id=?",
+            ("failed" if give_up else "pending", retry_at, str(e), message["id"])), db_name)
+        if give_up:
+            print(f"❌ Giving up on report email {message['id']} after {attempts} attempts: {e}")
+        else:
+            print(f"⚠️ Report email {message['id']} failed (attempt {attempts}), retrying "
+                  f"at {datetime.fromtimestamp(retry_at):%H:%M:%S}: {e}")
+        return False
+    run_write(lambda conn: conn.execute("UPDATE email_outbox SET status='sent', last_error=NULL WHERE id=?",
+                                        (message["id"],)), db_name)
+    _remove_reports(files)
+    print(f"✅ Report email {message['id']} sent.")
+    return True
+
+def drain_outbox(max_workers=EMAIL_WORKERS, db_name=DB_NAME):
+    """Send every queued email that is due, max_workers at a time; returns the number sent."""
+    if send_email.credentials_missing():
+        print("❌ Email credentials are missing in .env; report emails stay queued.")
+        return 0
+    sent = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while True:
+            due = _claim_due(max_workers, db_name)
+            if not due:
+                break
+            sent += sum(pool.map(lambda message: _send(message, db_name), due))
+    return sent
+
+def _remove_reports(files):
+    # Only files the pipeline wrote itself.
+    for f in files:
+        if os.path.dirname(os.path.abspath(f)) == os.path.abspath(REPORT_DIR) and os.path.exists(f):
+            os.remove(f)
+
+# -------------------
+# CYCLE
+# -------------------
+def run_report_cycle(force=False, db_name=DB_NAME):
+    """Export and queue the reports if the data changed, then send what is due."""
+    started = time.perf_counter()
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    files = []
+    if REPORT_MODE == "delta":
+        # An empty delta is the "nothing changed" case; no fingerprint needed.
+        files = _delta_files(export_delta(output_dir=REPORT_DIR, db_name=db_name, state_key=DELTA_STATE))
+        if files:
+            enqueue_report(files, send_email.REPORT_SUBJECT + " (changes)", supersede=False, db_name=db_name)
+    else:
+        # The fingerprint and the three exports all read the same snapshot
+        # when snapshots are enabled, so the workbooks agree with each other.
+        source = snapshot_db(db_name=db_name)
+        fingerprint = data_fingerprint(source)
+        if not force and fingerprint == get_job_state(FINGERPRINT, conn=get_conn(db_name)):
+            print(f"[{datetime.now()}] Reports unchanged since the last export, skipping.")
+        else:
+            files = export_to_excel(parallel=True, db_name=source, output_dir=REPORT_DIR)
+            # Nothing written (empty tables or a failed export): try again next cycle.
+            if files:
+                enqueue_report(files, db_name=db_name)
+                run_write(lambda conn: set_job_state(FINGERPRINT, fingerprint, conn=conn), db_name)
+    sent = drain_outbox(db_name=db_name)
+    observe_job("report_pipeline", time.perf_counter() - started, items=len(files))
+    print(f"[{datetime.now()}] Report cycle finished: {len(files)} files exported, {sent} emails sent.")
+    return files, sent
+
+def _delta_files(manifest):
+    with open(manifest) as f:
+        listed = json.load(f)["files"]
+    files = [os.path.join(REPORT_DIR, entry["file"]) for entry in listed] + [manifest]
+    # Nothing changed since the last report: drop the empty delta.
+    if not any(entry["rows"] for entry in listed):
+        _remove_reports(files)
+        return []
+    return files
+
+def start_report_jobs(scheduler, minutes=REPORT_INTERVAL_MINUTES):
+    """Add the report cycle to an APScheduler scheduler."""
+    scheduler.add_job(run_report_cycle, 'interval', minutes=minutes, coalesce=True, max_instances=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the Excel reports and email them when the data changes")
+    parser.add_argument('--once', action='store_true', help='Run a single cycle and exit')
+    parser.add_argument('--force', action='store_true', help='Export even if the data did not change')
+    parser.add_argument('--interval', type=int, default=REPORT_INTERVAL_MINUTES, help='Minutes between cycles')
+    args = parser.parse_args()
+    from migrations import migrate
+    migrate()
+    run_report_cycle(force=args.force)
+    while not args.once:
+        time.sleep(args.interval * 60)
+        run_report_cycle()
@@ -1,43 +1,31 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+import time
 from datetime import datetime
-from database import search_users, get_repayments_by_user, get_momopays, update_momopay_balance, mark_repayment_as_paid, share_float
+from deduction import check_allocation, run_auto_deduction
+from metrics import observe_job
 
 def auto_deduct_repayments():
     print(f"[{datetime.now()}] Running auto deduction...")
-    today = datetime.now()
-    users = search_users()
-    momopays = get_momopays()
-    merged_balance = sum(m['balance'] for m in momopays)
-
-    for user in users:
-        repayments = get_repayments_by_user(user['id'])
-        for r in repayments:
-            if r['status'] != "Paid":
-                due_date = datetime.strptime(r['due_date'], "%Y-%m-%d %H:%M:%S")
-                if due_date <= today:
-                    # Deduct from user's registered MoMoPay if possible
-                    c_user_momopay = next((m for m in momopays if m["phone"] == user['phone']), None)
-                    if c_user_momopay and c_user_momopay['balance'] >= r['amount']:
-                        update_momopay_balance(user['phone'], r['amount'])
-                    else:
-                        # Deduct proportionally from merged MoMoPay accounts
-                        proportion = r['amount'] / merged_balance if merged_balance > 0 else 0
-                        for m in momopays:
-                            deduction = m['balance'] * proportion
-                            update_momopay_balance(m['phone'], deduction)
-
-                    # Mark repayment as paid and share float
-                    mark_repayment_as_paid(r['id'])
-                    share_float(r['id'])
-
-    print(f"[{datetime.now()}] Auto deduction finished.")
+    started = time.perf_counter()
+    result = run_auto_deduction()
+    observe_job("auto_deduction", time.perf_counter() - started, items=result["due"])
+    print(f"[{datetime.now()}] Auto deduction finished: {result['due']} due since {result['since'] or 'the beginning'}, "
+          f"{result['own_account']} from own account, {result['pooled']} from merged accounts.")
+    if result["deducted"]:
+        print(f"  Deducted RWF {round(sum(result['deducted'].values()), 2)} "
+              f"across {len(result['deducted'])} MoMoPay accounts.")
 
 # -------------------
 # Scheduler
 # -------------------
 def start_scheduler():
+    # Fail now, not in every run, when the configured allocation cannot run.
+    check_allocation()
     scheduler = BackgroundScheduler()
     # Run every minute for testing (can change to hours/days)
-    scheduler.add_job(auto_deduct_repayments, 'interval', minutes=1)
+    # First run right away to catch up on windows missed while stopped; a
+    # slow run is never stacked with the next one.
+    scheduler.add_job(auto_deduct_repayments, 'interval', minutes=1,
+                      next_run_time=datetime.now(), coalesce=True, max_instances=1)
     scheduler.start()
     print("Scheduler started for auto deduction.")
@@ -1,7 +1,9 @@
 import smtplib
+import time
 from email.message import EmailMessage
 import os
 from dotenv import load_dotenv
+from metrics import EMAIL_DURATION
 
 # -------------------
 # LOAD ENVIRONMENT VARIABLES
@@ -10,20 +12,28 @@ load_dotenv()
 SENDER = os.getenv("EMAIL_SENDER")
 RECEIVER = os.getenv("EMAIL_RECEIVER")
 PASSWORD = os.getenv("EMAIL_PASSWORD")
+# Gmail over SSL by default. A local stand-in (python -m aiosmtpd -n, a
+# test server) takes SMTP_HOST=localhost SMTP_PORT=8025 SMTP_SSL=0 and no
+# password.
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_SSL = os.getenv("SMTP_SSL", "1").lower() not in ("0", "false", "no", "off")
+SMTP_TIMEOUT_SECONDS = int(os.getenv("SMTP_TIMEOUT", "60"))
+
+REPORT_SUBJECT = "Loan Reports – Registered Users & Repayment Schedules"
+# (maintype, subtype) per attachment extension.
+ATTACHMENT_TYPES = {
+    ".xlsx": ("application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ".csv": ("text", "csv"),
+    ".json": ("application", "json"),
+}
 
 # -------------------
-# FUNCTION TO SEND EMAIL WITH ATTACHMENTS
+# BUILDING AND SENDING
 # -------------------
-def send_report_email(attachments=None):
-    if attachments is None:
-        attachments = []
-
-    if not SENDER or not RECEIVER or not PASSWORD:
-        print("❌ Email credentials are missing in .env")
-        return
-
+def build_report_message(attachments=(), subject=REPORT_SUBJECT):
     msg = EmailMessage()
-    msg["Subject"] = "Loan Reports – Registered Users & Repayment Schedules"
+    msg["Subject"] = subject
     msg["From"] = SENDER
     msg["To"] = RECEIVER
     msg.set_content("Find attached the latest loan registration and repayment reports.")
@@ -31,24 +41,51 @@ def send_report_email(attachments=None):
     # Attach files if they exist
     for filename in attachments:
         if os.path.exists(filename):
+            maintype, subtype = ATTACHMENT_TYPES.get(os.path.splitext(filename)[1], ATTACHMENT_TYPES[".xlsx"])
             with open(filename, "rb") as f:
                 msg.add_attachment(
                     f.read(),
-                    maintype="application",
-                    subtype="vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    filename=filename
+                    maintype=maintype,
+                    subtype=subtype,
+                    filename=os.path.basename(filename)
                 )
         else:
             print(f"⚠️ File not found, skipping: {filename}")
+    return msg
 
-    # Send email
+def deliver(msg):
+    """Send one message over SMTP; raises on any failure."""
+    started = time.perf_counter()
+    smtp_class = smtplib.SMTP_SSL if SMTP_SSL else smtplib.SMTP
     try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login(SENDER, PASSWORD)
+        with smtp_class(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT_SECONDS) as smtp:
+            if PASSWORD:
+                smtp.login(SENDER, PASSWORD)
             smtp.send_message(msg)
+    except Exception:
+        EMAIL_DURATION.observe(time.perf_counter() - started, outcome="failed")
+        raise
+    EMAIL_DURATION.observe(time.perf_counter() - started, outcome="sent")
+
+def credentials_missing():
+    # Without a password the server must accept mail unauthenticated.
+    return not SENDER or not RECEIVER or (SMTP_SSL and not PASSWORD)
+
+# -------------------
+# FUNCTION TO SEND EMAIL WITH ATTACHMENTS
+# -------------------
+def send_report_email(attachments=None):
+    if credentials_missing():
+        print("❌ Email credentials are missing in .env")
+        return False
+
+    try:
+        deliver(build_report_message(attachments or []))
         print("✅ Email sent successfully.")
+        return True
     except Exception as e:
         print(f"❌ Failed to send email: {e}")
+        return False
 
 # -------------------
 # RUN DIRECTLY
@@ -0,0 +1,202 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+from db_pool import DB_NAME, get_conn, run_write
+from ussd_menu import SESSION_FIELDS
+
+# ----------------------
+# CONFIGURATION
+# ----------------------
+# USSD_SESSION_STORE picks the backend:
+#   memory - bounded dict inside each worker (one gunicorn worker only)
+#   shared - one store served over a local socket to every worker (the
+#            default when USSD_SESSION_SOCKET is set)
+#   sqlite - the ussd_sessions table
+# With several workers a session's requests land on different processes,
+# so gunicorn.conf.py refuses to start them on the memory store.
+STORE_BACKEND = (os.environ.get("USSD_SESSION_STORE")
+                 or ("shared" if os.environ.get("USSD_SESSION_SOCKET") else "memory")).lower()
+# Gateways drop a USSD session after roughly 90 seconds of inactivity.
+SESSION_TTL_SECONDS = int(os.environ.get("USSD_SESSION_TTL", "180"))
+MAX_SESSIONS = int(os.environ.get("USSD_SESSION_MAX", "50000"))
+SOCKET_PATH = os.environ.get("USSD_SESSION_SOCKET", "/tmp/ussd_sessions.sock")
+SOCKET_AUTHKEY = os.environ.get("USSD_SESSION_AUTHKEY", "ussd-sessions").encode()
+# The registration answers a session keeps come from the states in
+# ussd_menu.json (ussd_menu.SESSION_FIELDS).
+
+# ----------------------
+# BACKENDS
+# ----------------------
+class MemorySessionStore:
+    """Sessions kept in an LRU-ordered dict with a sliding TTL.
+
+    Every write moves the session to the end and pushes its expiry out, so
+    the oldest entry is always first: expiry and LRU eviction both pop from
+    the front.
+    """
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._sessions:
+            session_id, (expires_at, _) = next(iter(self._sessions.items()))
+            if expires_at > now and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._sessions[session_id]
+                return None
+            return dict(entry[1])
+
+    def upsert(self, session_id, phone=None, step=None, **kwargs):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            data = entry[1] if entry and entry[0] > now else {"session_id": session_id, "phone": None, "step": 0}
+            if phone is not None:
+                data["phone"] = phone
+            if step is not None:
+                data["step"] = step
+            for k, v in kwargs.items():
+                if k in SESSION_FIELDS:
+                    data[k] = v
+            self._sessions[session_id] = (now + self.ttl, data)
+            self._evict(now)
+
+    def clear(self, session_id, conn=None):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SqliteSessionStore:
+    """Sessions in the ussd_sessions table (the original storage).
+
+    Registration answers are kept as one JSON object in the answers column
+    (migration 11).
+    """
+
+    def get(self, session_id):
+        row = get_conn(DB_NAME).execute("SELECT session_id, phone, step, answers FROM ussd_sessions WHERE session_id=?",
+                                        (session_id,)).fetchone()
+        if not row:
+            return None
+        session = {"session_id": row["session_id"], "phone": row["phone"], "step": row["step"]}
+        session.update(json.loads(row["answers"] or "{}"))
+        return session
+
+    def upsert(self, session_id, phone=None, step=None, **kwargs):
+        answers = json.dumps({k: v for k, v in kwargs.items() if k in SESSION_FIELDS})
+        def _upsert(conn):
+            conn.execute("INSERT OR IGNORE INTO ussd_sessions (session_id) VALUES (?)", (session_id,))
+            conn.execute("""
+                UPDATE ussd_sessions SET phone=COALESCE(?, phone), step=COALESCE(?, step),
+                    answers=json_patch(COALESCE(answers, '{}'), ?)
+                WHERE session_id=?
+            """, (phone, step, answers, session_id))
+        run_write(_upsert, DB_NAME)
+
+    def clear(self, session_id, conn=None):
+        # With conn, the delete joins the caller's open transaction.
+        if conn is not None:
+            conn.execute("DELETE FROM ussd_sessions WHERE session_id=?", (session_id,))
+        else:
+            run_write(lambda conn: conn.execute("DELETE FROM ussd_sessions WHERE session_id=?", (session_id,)), DB_NAME)
+
+
+class _SessionManager(BaseManager):
+    pass
+
+
+class SharedSessionStore:
+    """Client for a MemorySessionStore served over a local socket.
+
+    Every gunicorn worker talks to the same `python session_store.py serve`
+    process, so a session started on one worker continues on any other.
+    """
+
+    def __init__(self, address=SOCKET_PATH, authkey=SOCKET_AUTHKEY):
+        self.address = address
+        self.authkey = authkey
+        self._pid = None
+        self._store = None
+
+    def _proxy(self):
+        if self._pid != os.getpid():
+            manager = _SessionManager(address=self.address, authkey=self.authkey)
+            manager.connect()
+            self._store = manager.sessions()
+            self._pid = os.getpid()
+        return self._store
+
+    def get(self, session_id):
+        return self._proxy().get(session_id)
+
+    def upsert(self, session_id, phone=None, step=None, **kwargs):
+        self._proxy().upsert(session_id, phone=phone, step=step, **kwargs)
+
+    def clear(self, session_id, conn=None):
+        self._proxy().clear(session_id)
+
+
+_SessionManager.register("sessions")
+
+# ----------------------
+# FACTORY
+# ----------------------
+def create_session_store(backend=STORE_BACKEND):
+    if backend == "sqlite":
+        return SqliteSessionStore()
+    if backend == "shared":
+        store = SharedSessionStore()
+        try:
+            store._proxy()
+            return store
+        except (OSError, EOFError) as e:
+            print(f"⚠️ Shared session store unavailable ({e}), falling back to SQLite sessions.")
+            return SqliteSessionStore()
+    return MemorySessionStore()
+
+
+def check_workers(workers, backend=STORE_BACKEND):
+    """Raise if `workers` server processes cannot share sessions on `backend`."""
+    if workers > 1 and backend == "memory":
+        raise RuntimeError(f"{workers} workers cannot share the in-memory USSD session store: set "
+                           "USSD_SESSION_SOCKET (and run 'python session_store.py serve') or "
+                           "USSD_SESSION_STORE=sqlite, or run one worker")
+
+
+def serve(address=SOCKET_PATH, authkey=SOCKET_AUTHKEY):
+    """Run the shared session store until interrupted."""
+    store = MemorySessionStore()
+    if os.path.exists(address):
+        os.remove(address)
+    _SessionManager.register("sessions", callable=lambda: store)
+    manager = _SessionManager(address=address, authkey=authkey)
+    print(f"✅ Serving USSD sessions on {address}")
+    manager.get_server().serve_forever()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["serve"]:
+        serve()
+    else:
+        print("Usage: python session_store.py serve")
@@ -0,0 +1,128 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from urllib.request import pathname2url
+from db_pool import BUSY_TIMEOUT_MS, DB_NAME, close_conn
+from metrics import observe_job
+
+# -------------------
+# READ SNAPSHOTS
+# -------------------
+# Long reports (Excel and CSV exports, view_users, the admin dashboard)
+# can read from a copy of the database made with SQLite's online backup
+# API instead of users.db itself. The copy is written to a temporary file
+# and renamed into place, so every reader sees one consistent point in
+# time, and readers of the copy never hold a lock on users.db while
+# /ussd and the deduction job write to it.
+#
+# Set USSD_SNAPSHOT_MAX_AGE to the staleness (in seconds) those reads may
+# accept; an older snapshot is retaken before use. Unset or 0 keeps every
+# read on users.db.
+SNAPSHOT_MAX_AGE_SECONDS = int(os.environ.get("USSD_SNAPSHOT_MAX_AGE", "0"))
+# Default: users_snapshot.db next to the database.
+SNAPSHOT_PATH = os.environ.get("USSD_SNAPSHOT_PATH")
+# How often the scheduler refreshes the snapshot, so readers seldom have
+# to wait for one; half the staleness bound unless set.
+SNAPSHOT_REFRESH_SECONDS = int(os.environ.get("USSD_SNAPSHOT_REFRESH", "0")) or max(SNAPSHOT_MAX_AGE_SECONDS // 2, 1)
+
+_refresh_lock = threading.Lock()
+# Per thread: the snapshot file each pooled read-only connection was opened on.
+_local = threading.local()
+
+def snapshot_path(db_name=DB_NAME):
+    if SNAPSHOT_PATH and db_name == DB_NAME:
+        return SNAPSHOT_PATH
+    return os.path.splitext(db_name)[0] + "_snapshot.db"
+
+def snapshot_uri(path):
+    # immutable: the file is replaced, never modified, so readers skip
+    # locking altogether.
+    return f"file:{pathname2url(os.path.abspath(path))}?mode=ro&immutable=1"
+
+def snapshot_age(path):
+    """Seconds since the snapshot at path was taken, or None if there is none."""
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+
+def take_snapshot(db_name=DB_NAME, path=None):
+    """Copy db_name to its snapshot file and return the snapshot path.
+
+    The backup runs in one step: in the default journal mode writers wait
+    while the pages are copied (a fraction of a second per 100MB), not for
+    the length of a report. In WAL mode they do not wait at all.
+    """
+    path = path or snapshot_path(db_name)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    started = time.time()
+    timer = time.perf_counter()
+    source = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT_MS / 1000)
+    dest = sqlite3.connect(tmp)
+    try:
+        source.backup(dest)
+        pages = dest.execute("PRAGMA page_count").fetchone()[0]
+        # A WAL source would make the copy a WAL database too.
+        dest.execute("PRAGMA journal_mode=DELETE")
+    except BaseException:
+        dest.close()
+        os.remove(tmp)
+        raise
+    finally:
+        source.close()
+    dest.close()
+    # The file time records when the copy was taken, not when it finished.
+    os.utime(tmp, (started, started))
+    os.replace(tmp, path)
+    seconds = time.perf_counter() - timer
+    observe_job("snapshot", seconds, items=pages)
+    print(f"[{datetime.now()}] ✅ Snapshot of {db_name} saved to {path} ({pages} pages, {seconds:.2f}s)")
+    return path
+
+def snapshot_db(max_age=SNAPSHOT_MAX_AGE_SECONDS, db_name=DB_NAME):
+    """Return the database name a long read should pass as db_name.
+
+    That is db_name itself when max_age is 0, otherwise a read-only URI for
+    a snapshot at most max_age seconds old, taken first if need be.
+    """
+    if max_age <= 0:
+        return db_name
+    path = snapshot_path(db_name)
+    age = snapshot_age(path)
+    if age is None or age > max_age:
+        with _refresh_lock:
+            # Another thread may have refreshed it while we waited.
+            age = snapshot_age(path)
+            if age is None or age > max_age:
+                take_snapshot(db_name, path)
+    uri = snapshot_uri(path)
+    # A pooled connection keeps reading the file it was opened on; reopen
+    # it once the snapshot has been replaced.
+    opened = getattr(_local, "opened", None)
+    if opened is None:
+        opened = _local.opened = {}
+    inode = os.stat(path).st_ino
+    if opened.get(uri) != inode:
+        close_conn(uri)
+        opened[uri] = inode
+    return uri
+
+def start_snapshot_jobs(scheduler, seconds=SNAPSHOT_REFRESH_SECONDS):
+    """Add the snapshot refresh to an APScheduler scheduler, when snapshots are enabled."""
+    if SNAPSHOT_MAX_AGE_SECONDS > 0:
+        scheduler.add_job(take_snapshot, 'interval', seconds=seconds, next_run_time=datetime.now(),
+                          coalesce=True, max_instances=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy the database to a read-only snapshot for reports")
+    parser.add_argument('--path', help='Snapshot file (default: USSD_SNAPSHOT_PATH or <db>_snapshot.db)')
+    parser.add_argument('--interval', type=int, help='Keep refreshing the snapshot every this many seconds')
+    args = parser.parse_args()
+    take_snapshot(path=args.path)
+    while args.interval:
+        time.sleep(args.interval)
+        take_snapshot(path=args.path)
@@ -0,0 +1,47 @@
+from db_pool import DB_NAME, get_conn
+
+# ----------------------
+# USER SEARCH
+# ----------------------
+# Admin search matches name, phone and national ID anywhere in the text.
+# With the users_fts trigram index (migration 3) that is an index lookup
+# ranked by bm25; terms shorter than a trigram, or databases without FTS5,
+# fall back to a LIKE scan.
+FTS_MIN_CHARS = 3
+
+_fts_available = {}
+
+def fts_available(db_name=DB_NAME):
+    if db_name not in _fts_available:
+        row = get_conn(db_name).execute("SELECT 1 FROM sqlite_master WHERE name='users_fts'").fetchone()
+        _fts_available[db_name] = row is not None
+    return _fts_available[db_name]
+
+def user_search_source(search="", db_name=DB_NAME):
+    """Return (from_sql, rank_sql, params) selecting the users that match.
+
+    from_sql starts after FROM and exposes the matching rows as `users`.
+    Ordering by rank_sql, then users.id, lists the best matches first (or
+    plain id order when not searching).
+    """
+    search = (search or "").strip()
+    if not search:
+        return "users", "users.id", ()
+    if len(search) >= FTS_MIN_CHARS and fts_available(db_name):
+        # A quoted phrase is matched as a plain substring by the trigram
+        # tokenizer, whatever punctuation it contains.
+        phrase = '"' + search.replace('"', '""') + '"'
+        return ("users_fts JOIN users ON users.id = users_fts.rowid WHERE users_fts MATCH ?",
+                "users_fts.rank", (phrase,))
+    like = f"%{search}%"
+    return ("users WHERE full_name LIKE ? OR phone LIKE ? OR national_id LIKE ?",
+            "users.id", (like, like, like))
+
+def search_users(search="", db_name=DB_NAME):
+    source, rank, params = user_search_source(search, db_name)
+    rows = get_conn(db_name).execute(f"SELECT users.* FROM {source} ORDER BY {rank}, users.id", params).fetchall()
+    return [dict(r) for r in rows]
+
+def count_users(search="", db_name=DB_NAME):
+    source, _, params = user_search_source(search, db_name)
+    return get_conn(db_name).execute(f"SELECT COUNT(*) FROM {source}", params).fetchone()[0]
@@ -0,0 +1,234 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import Counter, REGISTRY
+from migrations import CHANGE_SEQ_SQL
+
+# ----------------------
+# CONFIGURATION
+# ----------------------
+# Rendered "Check Loan" and "View Repayments" replies of registered
+# borrowers, per phone. Writes in this process invalidate the affected
+# phones as soon as they commit. Writes made by other processes (another
+# gunicorn worker, the scheduler) are picked up on the next lookup through
+# the change counter (migration 10); see PhoneCache.sync.
+READ_CACHE_SIZE = int(os.environ.get("USSD_READ_CACHE_SIZE", "100000"))
+READ_CACHE_TTL_SECONDS = int(os.environ.get("USSD_READ_CACHE_TTL", "300"))
+
+# Last reply per USSD session, so a request the gateway retransmits is
+# answered again instead of being applied twice. Gateways give up on a
+# session after about 90 seconds.
+REPLY_CACHE_SIZE = int(os.environ.get("USSD_REPLY_CACHE_SIZE", "50000"))
+REPLY_CACHE_TTL_SECONDS = int(os.environ.get("USSD_REPLY_CACHE_TTL", "180"))
+# How long a retransmit waits for the original request to finish.
+REPLY_WAIT_SECONDS = float(os.environ.get("USSD_REPLY_WAIT", "10"))
+
+CACHE_LOOKUPS = Counter("ussd_read_cache_lookups_total", "USSD read cache lookups.", ("result",))
+# result: new, retransmit (answered from the cache) or in_flight (arrived
+# while the original was still being handled).
+REPLY_LOOKUPS = Counter("ussd_reply_cache_lookups_total", "USSD requests checked for gateway retransmits.",
+                        ("result",))
+REGISTRY.extend((CACHE_LOOKUPS, REPLY_LOOKUPS))
+
+# ----------------------
+# CACHE
+# ----------------------
+class PhoneCache:
+    """LRU of rendered replies keyed by phone, with a TTL.
+
+    An entry maps a reply kind to its payload and remembers the borrower's
+    user id, so writes that only know the user id can invalidate it.
+    Unregistered numbers are cached too (user id None); a registration from
+    any process, the bulk import included, writes a users row whose phone
+    sync() then drops. A reader takes `generation` before querying and
+    passes it to put(); if anything was invalidated in between, the
+    possibly stale reply is not stored.
+    """
+
+    def __init__(self, max_entries=READ_CACHE_SIZE, ttl=READ_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()  # phone -> (expires_at, user_id, {kind: payload})
+        self._phones_by_user = {}
+        self._lock = threading.Lock()
+        # change_seq the cache has caught up with; None until the first sync.
+        self.synced_seq = None
+
+    def _drop(self, phone):
+        entry = self._entries.pop(phone, None)
+        if entry is not None and entry[1] is not None and self._phones_by_user.get(entry[1]) == phone:
+            del self._phones_by_user[entry[1]]
+
+    def get(self, phone, kind):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(phone)
+            if entry is None or entry[0] <= now or kind not in entry[2]:
+                if entry is not None and entry[0] <= now:
+                    self._drop(phone)
+                CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(phone)
+            CACHE_LOOKUPS.inc(result="hit")
+            return entry[2][kind]
+
+    def sync(self, conn):
+        """Drop the entries of every borrower written since the last sync, by any process.
+
+        One primary key read when nothing changed; otherwise index range
+        scans over the rows changed since then.
+        """
+        seq = conn.execute(f"SELECT {CHANGE_SEQ_SQL}").fetchone()[0]
+        synced = self.synced_seq
+        if seq == synced:
+            return
+        if synced is None:
+            self.clear()
+        else:
+            changed = conn.execute("""
+                SELECT id, phone FROM users WHERE change_seq > ?1
+                UNION SELECT user_id, NULL FROM repayments WHERE change_seq > ?1
+                UNION SELECT CAST(row_key AS INTEGER), NULL FROM deleted_rows
+                      WHERE table_name = 'users' AND change_seq > ?1
+            """, (synced,)).fetchall()
+            if len(changed) >= self.max_entries:
+                self.clear()
+            else:
+                self.invalidate_users({row[0] for row in changed})
+                self.invalidate_phones({row[1] for row in changed if row[1]})
+        with self._lock:
+            if self.synced_seq is None or seq > self.synced_seq:
+                self.synced_seq = seq
+
+    def put(self, phone, kind, user_id, payload, generation):
+        now = time.monotonic()
+        with self._lock:
+            if generation != self.generation:
+                return
+            entry = self._entries.get(phone)
+            if entry is None or entry[1] != user_id or entry[0] <= now:
+                self._drop(phone)
+                entry = self._entries[phone] = (now + self.ttl, user_id, {})
+                if user_id is not None:
+                    self._phones_by_user[user_id] = phone
+            entry[2][kind] = payload
+            self._entries.move_to_end(phone)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_phones(self, phones):
+        with self._lock:
+            self.generation += 1
+            for phone in phones:
+                self._drop(phone)
+
+    def invalidate_users(self, user_ids):
+        with self._lock:
+            self.generation += 1
+            for user_id in user_ids:
+                phone = self._phones_by_user.get(user_id)
+                if phone is not None:
+                    self._drop(phone)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._phones_by_user.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ReplyCache:
+    """The last reply of every USSD session, keyed on (sessionId, text).
+
+    The gateway sends the whole input so far in `text`, so a request with
+    the same sessionId and text as the previous one is a retransmit. The
+    first request claims the pair with begin() and stores its reply with
+    finish() (or abandon() if it failed); a retransmit gets that reply,
+    waiting for it if the original is still running. Each worker process
+    has its own cache.
+    """
+
+    def __init__(self, max_entries=REPLY_CACHE_SIZE, ttl=REPLY_CACHE_TTL_SECONDS, wait=REPLY_WAIT_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.wait = wait
+        # session_id -> [expires_at, text, payload or None while in flight, done event]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _drop(self, session_id):
+        entry = self._entries.pop(session_id)
+        # Waiters on an evicted request handle it themselves.
+        entry[3].set()
+
+    def _evict(self, now):
+        # Every write moves its entry to the end, so the oldest is first.
+        while self._entries:
+            session_id, entry = next(iter(self._entries.items()))
+            if entry[0] > now and len(self._entries) <= self.max_entries:
+                break
+            self._drop(session_id)
+
+    def _claim(self, session_id, text, now):
+        if session_id in self._entries:
+            self._drop(session_id)
+        self._entries[session_id] = [now + self.ttl, text, None, threading.Event()]
+        self._evict(now)
+
+    def begin(self, session_id, text):
+        """Return the stored reply for a retransmit, or None when the caller must answer."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[0] <= now or entry[1] != text:
+                REPLY_LOOKUPS.inc(result="new")
+                self._claim(session_id, text, now)
+                return None
+            if entry[2] is not None:
+                REPLY_LOOKUPS.inc(result="retransmit")
+                return entry[2]
+            REPLY_LOOKUPS.inc(result="in_flight")
+        entry[3].wait(self.wait)
+        with self._lock:
+            if entry[2] is not None:
+                return entry[2]
+            # The original failed, was evicted or is still running: answer
+            # this one instead.
+            self._claim(session_id, text, time.monotonic())
+            return None
+
+    def finish(self, session_id, text, payload):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[1] != text:
+                return
+            entry[0] = now + self.ttl
+            entry[2] = payload
+            entry[3].set()
+            self._entries.move_to_end(session_id)
+
+    def abandon(self, session_id, text):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry[1] == text and entry[2] is None:
+                self._drop(session_id)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+READ_CACHE = PhoneCache()
+REPLY_CACHE = ReplyCache()
+
+def invalidate_phones(*phones):
+    READ_CACHE.invalidate_phones(phones)
+
+def invalidate_users(*user_ids):
+    READ_CACHE.invalidate_users(user_ids)
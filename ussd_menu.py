@@ -0,0 +1,113 @@
+import json
+import os
+from collections import namedtuple
+
+# ----------------------
+# MENU DEFINITION
+# ----------------------
+# The USSD menu tree, registration steps and every reply live in
+# ussd_menu.json (or the file named by USSD_MENU_PATH), so prompts, order
+# and options change without code edits. It is read once at import and
+# turned into dicts: resolving a menu option or a registration state is a
+# single lookup, however many there are.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MENU_PATH = os.environ.get("USSD_MENU_PATH") or os.path.join(BASE_DIR, "ussd_menu.json")
+
+# One registration state: the answer is checked by `validate`, stored under
+# `field`, and the session moves to `next` (a state number or "complete").
+# `prompt` is the question that leads into the state, already encoded.
+State = namedtuple("State", "number field prompt validate next invalid")
+
+# ----------------------
+# VALIDATORS
+# ----------------------
+# Each takes the raw answer and returns the value to store, or raises
+# ValueError.
+def _text(value):
+    return value.strip()
+
+def _amount(value):
+    return float(value)
+
+def _days(value):
+    return int(value)
+
+VALIDATORS = {"text": _text, "amount": _amount, "days": _days}
+
+# ----------------------
+# BORROWER FIELDS
+# ----------------------
+# The register_user arguments a registration state may collect, and the
+# validator each one needs. Fields the menu leaves out are registered as
+# NULL; the repayment schedule needs the loan amount and duration.
+USER_FIELDS = {
+    "national_id": "text",
+    "full_name": "text",
+    "address": "text",
+    "father_name": "text",
+    "mother_name": "text",
+    "loan_amount": "amount",
+    "duration": "days",
+}
+REQUIRED_FIELDS = ("loan_amount", "duration")
+
+# ----------------------
+# LOADING
+# ----------------------
+def load_menu(path=MENU_PATH):
+    """Read a menu file and return (menu_prompt, options, first_state, states, messages)."""
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    messages = config["messages"]
+    registration = config["registration"]
+    states = {}
+    for number, spec in registration["states"].items():
+        if spec["field"] not in USER_FIELDS:
+            raise ValueError(f"Unknown field {spec['field']!r} in state {number} of {path}; "
+                             f"choose from {', '.join(USER_FIELDS)}")
+        if spec["validator"] not in VALIDATORS:
+            raise ValueError(f"Unknown validator {spec['validator']!r} in state {number} of {path}")
+        if spec["validator"] != USER_FIELDS[spec["field"]]:
+            raise ValueError(f"State {number} of {path} must check {spec['field']} with the "
+                             f"{USER_FIELDS[spec['field']]!r} validator")
+        invalid = spec.get("invalid", "invalid_state")
+        if invalid not in messages:
+            raise ValueError(f"Unknown message {invalid!r} in state {number} of {path}")
+        states[int(number)] = State(int(number), spec["field"], spec["prompt"].encode(),
+                                    VALIDATORS[spec["validator"]], spec["next"], invalid)
+    for state in states.values():
+        if state.next != "complete" and state.next not in states:
+            raise ValueError(f"State {state.number} of {path} leads to unknown state {state.next!r}")
+    if registration["first_state"] not in states:
+        raise ValueError(f"Unknown first_state in {path}")
+    menu = config["menu"]
+    return menu["prompt"].encode(), dict(menu["options"]), registration["first_state"], states, messages
+
+MENU_PROMPT, OPTIONS, FIRST_STATE, STATES, MESSAGES = load_menu()
+
+# Registration states in the order a single-shot "1*id*name*..." request
+# carries their answers.
+REGISTRATION_STATES = []
+_number = FIRST_STATE
+while _number != "complete":
+    if STATES[_number] in REGISTRATION_STATES:
+        raise ValueError(f"Registration states loop back to state {_number} in {MENU_PATH}")
+    REGISTRATION_STATES.append(STATES[_number])
+    _number = STATES[_number].next
+
+# The answers a registration session carries, in the order they are asked.
+SESSION_FIELDS = tuple(state.field for state in REGISTRATION_STATES)
+if len(set(SESSION_FIELDS)) != len(SESSION_FIELDS):
+    raise ValueError(f"Registration states in {MENU_PATH} ask for the same field twice")
+_missing = [field for field in REQUIRED_FIELDS if field not in SESSION_FIELDS]
+if _missing:
+    raise ValueError(f"Registration states in {MENU_PATH} never ask for {', '.join(_missing)}")
+
+# Replies without placeholders, encoded once.
+ENCODED_MESSAGES = {name: text.encode() for name, text in MESSAGES.items() if "{" not in text}
+
+def message(name, **values):
+    """Encoded reply `name`, with its placeholders filled from values."""
+    if not values:
+        return ENCODED_MESSAGES[name]
+    return MESSAGES[name].format(**values).encode()
@@ -11,6 +11,13 @@ def parse_datetime(dt_str):
     """Convert string to datetime object."""
     return datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
 
+def parse_since(value):
+    """Unix seconds from an integer or a local 'YYYY-MM-DD[ HH:MM:SS]' string."""
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp())
+
 def countdown_to(target_dt):
     """Return remaining time in days, hours, minutes."""
     now = datetime.now()